@@ -0,0 +1,317 @@
+import os, csv, json, time, signal, itertools, multiprocessing
+from VM import VM
+from BatchVM import BatchVM, BatchError
+from Counters import score
+from CompileCache import CompileCache
+from ProgramImage import IMAGE_EXTENSION
+from Fixture import find_fixture
+from Enums import *
+
+REPORT_FIELDS = ['tis', 'fixture', 'tests', 'status', 'passed', 'cycles', 'nodes', 'instructions',
+                 'seconds', 'error', 'stuck', 'mismatches']
+
+# extra seconds the hard timer leaves the VM to stop on its own budget
+TIMER_GRACE = 1.0
+# seconds between two looks at the workers, with or without a timeout
+POLL_INTERVAL = 0.5
+# extra seconds a job may run past its timer before its worker is given up on
+LOST_GRACE = 5.0
+
+class JobTimeout(Exception):
+    pass
+
+def find_jobs(path):
+    '''Returns (tis, fixture) pairs from a directory or a manifest file.
+
+    A manifest is either a JSON list of [tis, fixture] pairs or
+    {"tis": ..., "fixture": ...} objects, or a text file with one
+    "tis [fixture]" pair per line. Relative paths are resolved from the
+    manifest directory, a missing fixture defaults to the sibling .tisf
+    or .json file.
+    '''
+    if os.path.isdir(path):
+        jobs = []
+        for name in sorted(os.listdir(path)):
+            if os.path.splitext(name)[1] in ('.tis', IMAGE_EXTENSION):
+                jobs.append(_job(path, name, None))
+        return jobs
+
+    base_dir = os.path.dirname(path)
+    f = open(path, 'r')
+    content = f.read()
+    f.close()
+
+    entries = []
+    if path.endswith('.json'):
+        for entry in json.loads(content):
+            if isinstance(entry, dict):
+                entries.append((entry['tis'], entry.get('fixture')))
+            else:
+                entries.append((entry[0], entry[1] if len(entry) > 1 else None))
+    else:
+        for line in content.splitlines():
+            words = line.split('#')[0].split()
+            if len(words) > 0:
+                entries.append((words[0], words[1] if len(words) > 1 else None))
+    return [_job(base_dir, tis, fixture) for tis, fixture in entries]
+
+def _job(base_dir, tis, fixture):
+    tis = os.path.join(base_dir, tis)
+    if fixture is not None:
+        fixture = os.path.join(base_dir, fixture)
+    else:
+        fixture = find_fixture(tis)
+    return (tis, fixture)
+
+# the (owners, starts) arrays the workers report their progress to
+_progress = None
+
+def _init_worker(progress=None):
+    global _progress
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _progress = progress
+
+# one compile cache per worker process and directory
+_caches = {}
+
+def get_cache(path):
+    if path not in _caches:
+        _caches[path] = CompileCache(path)
+    return _caches[path]
+
+def _on_alarm(signum, frame):
+    raise JobTimeout()
+
+def run_job(job, timeout=None, scheduler='lockstep', max_cycles=None, fast_forward=False,
+            cache_dir=None, codegen=False, stop_on_mismatch=True, batched=True):
+    '''Runs every test set of a job and returns its record.
+
+    When batched, a job with several test sets stopping on mismatches
+    runs them all at once on a BatchVM, and falls back to one run per
+    test set when the program is not one BatchVM can run.
+    '''
+    tis, fixture = job
+    record = {'tis': tis, 'fixture': fixture, 'tests': 0, 'status': RUN_ERROR, 'passed': False,
+              'cycles': 0, 'nodes': 0, 'instructions': 0, 'seconds': 0.0, 'error': None,
+              'stuck': [], 'mismatches': []}
+    start = time.time()
+    vm = None
+    use_alarm = timeout and hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout + TIMER_GRACE)
+    try:
+        vm = VM(cache=get_cache(cache_dir) if cache_dir else None, codegen=codegen)
+        vm.load(tis, fixture)
+        tests = len(vm.fixture) if vm.fixture is not None else 1
+        results = None
+        if batched and tests > 1 and stop_on_mismatch:
+            results = _batch_results(vm, tests, start, timeout, scheduler, max_cycles, fast_forward)
+        if results is None:
+            results = _test_results(vm, 0, tests, start, timeout, scheduler, max_cycles, fast_forward,
+                                    stop_on_mismatch)
+        for test, result in enumerate(results):
+            record['tests'] = test + 1
+            record['cycles'] = max(record['cycles'], result['cycles'])
+            record['nodes'] = result['score']['nodes']
+            record['instructions'] = result['score']['instructions']
+            # the first test set that fails is the one reported
+            record['status'] = result['status']
+            record['stuck'] = result['stuck']
+            record['mismatches'] = result.get('mismatches', [])
+            # a job passes when its checked test sets do, None when none is checked
+            if result['passed'] is not None or test == 0:
+                record['passed'] = result['passed']
+            if result['passed'] is False:
+                break
+        if record['status'] == RUN_TIMEOUT:
+            record['error'] = "Timed out after %gs" % timeout
+    except JobTimeout:
+        record['status'] = RUN_TIMEOUT
+        record['error'] = "Timed out after %gs" % timeout
+        if vm is not None:
+            record['cycles'] = vm.cycle
+    except Exception as e:
+        record['error'] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    record['seconds'] = round(time.time() - start, 6)
+    return record
+
+def _test_results(vm, first, tests, start, timeout, scheduler, max_cycles, fast_forward,
+                  stop_on_mismatch):
+    '''Runs the test sets from first one after the other, yielding their results'''
+    for test in range(first, tests):
+        # the timeout covers every test set of the job, each run gets what is left of it
+        budget = None
+        if timeout:
+            budget = start + timeout - time.time()
+            if budget <= 0:
+                raise JobTimeout()
+        if test > 0:
+            vm.reset(vm.fixture[test])
+        yield vm.run(scheduler, max_cycles, budget, fast_forward, stop_on_mismatch)
+
+def _batch_results(vm, tests, start, timeout, scheduler, max_cycles, fast_forward):
+    '''Runs every test set at once on a BatchVM, None when it cannot run the program.
+
+    The first test set that fails runs again on the VM, so its result
+    tells where the run got stuck like it does without batching.
+    '''
+    try:
+        batch = BatchVM.for_tests(vm, [vm.fixture[test] for test in range(tests)])
+    except BatchError:
+        return None
+    results = batch.run(max_cycles, timeout or None)
+    for test, result in enumerate(results):
+        if result['passed'] is False:
+            return itertools.chain(results[:test], _test_results(vm, test, test + 1, start, timeout,
+                                                                 scheduler, max_cycles, fast_forward,
+                                                                 True))
+        result['stuck'] = []
+        result['score'] = score(vm)
+    return results
+
+def run_chunk(entries, timeout=None, **options):
+    '''Runs (index, job) entries, returns their (index, record) pairs.
+
+    The worker marks every entry of the chunk as its own, and each job
+    with the time it started and -1 once it finished, so run_jobs can
+    tell which job was running when the worker got lost.
+    '''
+    if _progress is not None:
+        owners, starts = _progress
+        for index, job in entries:
+            owners[index] = os.getpid()
+    records = []
+    for index, job in entries:
+        if _progress is not None:
+            starts[index] = time.time()
+        records.append((index, run_job(job, timeout, **options)))
+        if _progress is not None:
+            starts[index] = -1
+    return records
+
+def run_jobs(jobs, workers=None, chunksize=4, timeout=60, **options):
+    '''Runs jobs on a process pool and returns one record per job.
+
+    Jobs are sent in chunks to keep IPC low. Each job, all its test sets
+    together, is bounded by its own timer inside the worker. The pool is
+    looked at every POLL_INTERVAL: when the worker of a chunk died, or a
+    job ran LOST_GRACE past its timer, only the job it was running is
+    reported as lost and the rest of the chunk is sent again. The other
+    options are passed on to run_job.
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    owners = multiprocessing.Array('i', len(jobs), lock=False)
+    starts = multiprocessing.Array('d', len(jobs), lock=False)
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=((owners, starts),))
+    records = [None] * len(jobs)
+
+    def submit(entries):
+        for index, job in entries:
+            owners[index] = 0
+            starts[index] = 0
+        return (entries, pool.apply_async(run_chunk, (entries, timeout), options))
+
+    def lost(entries):
+        '''The index of the job a chunk lost and why, None while it is fine'''
+        for index, job in entries:
+            if starts[index] > 0 and timeout and \
+                    time.time() - starts[index] > timeout + TIMER_GRACE + LOST_GRACE:
+                # the pool only gets its place back once the worker is gone
+                _kill(owners[index])
+                return index, 'Worker stopped responding'
+        if owners[entries[0][0]] > 0 and not _alive(owners[entries[0][0]]):
+            running = [index for index, job in entries if starts[index] > 0]
+            return (running[0] if running else None), 'Worker lost'
+        return None
+
+    try:
+        entries = list(enumerate(jobs))
+        pending = [submit(entries[i:i + chunksize]) for i in range(0, len(entries), chunksize)]
+        while len(pending) > 0:
+            waiting = []
+            for entries, async_result in pending:
+                if async_result.ready():
+                    try:
+                        for index, record in async_result.get():
+                            records[index] = record
+                    except Exception as e:
+                        for index, job in entries:
+                            records[index] = _lost_record(job, "%s: %s" % (type(e).__name__, e))
+                    continue
+                found = lost(entries)
+                if found is None:
+                    waiting.append((entries, async_result))
+                    continue
+                index, error = found
+                if index is not None:
+                    records[index] = _lost_record(jobs[index], error)
+                # the records of the chunk went down with it, run the others again
+                rest = [(i, job) for i, job in entries if i != index]
+                if len(rest) > 0:
+                    waiting.append(submit(rest))
+            pending = waiting
+            if len(pending) > 0:
+                pending[0][1].wait(POLL_INTERVAL)
+    finally:
+        pool.terminate()
+        pool.join()
+    return records
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def _kill(pid):
+    try:
+        os.kill(pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+    except OSError:
+        pass
+
+def _lost_record(job, error):
+    tis, fixture = job
+    return {'tis': tis, 'fixture': fixture, 'tests': 0, 'status': RUN_ERROR, 'passed': False,
+            'cycles': 0, 'nodes': 0, 'instructions': 0, 'seconds': 0.0, 'error': error,
+            'stuck': [], 'mismatches': []}
+
+def write_report(records, filename):
+    if filename.endswith('.csv'):
+        f = open(filename, 'wb')
+        writer = csv.DictWriter(f, REPORT_FIELDS)
+        writer.writeheader()
+        for record in records:
+            row = dict(record)
+            row['stuck'] = format_stuck(record['stuck'])
+            row['mismatches'] = format_mismatches(record['mismatches'])
+            writer.writerow(row)
+        f.close()
+    else:
+        f = open(filename, 'w')
+        json.dump({'jobs': records, 'summary': summarize(records)}, f, indent=2)
+        f.close()
+
+def format_stuck(stuck):
+    return ' '.join("%s%i:%s:%s" % (s['kind'][0], s['node'], s['state'], s['port']) for s in stuck)
+
+def format_mismatches(mismatches):
+    return ' '.join("o%i[%i]:%s!=%s" % (m['output'], m['index'], m['value'], m['expected'])
+                    for m in mismatches)
+
+def summarize(records):
+    summary = {'jobs': len(records), 'passed': 0, 'failed': 0, 'unchecked': 0}
+    for record in records:
+        if record['passed'] is None:
+            summary['unchecked'] += 1
+        elif record['passed']:
+            summary['passed'] += 1
+        else:
+            summary['failed'] += 1
+        summary[record['status']] = summary.get(record['status'], 0) + 1
+    return summary
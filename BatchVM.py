@@ -0,0 +1,516 @@
+import time
+from Scheduler import CLOCK_CHECK_INTERVAL
+from Enums import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class BatchError(Exception):
+    pass
+
+class BatchVM(object):
+    '''Runs one loaded program against many input sets in lockstep.
+
+    Every instance keeps its state in NumPy arrays shaped (batch, node), and
+    each cycle replays the mailbox resolve and the node cycles of the
+    lockstep scheduler with one vectorized update per instruction, masked
+    to the rows whose IP points at it. The slot of a writer is its outbox
+    and the waiting flag of a reader stands for the one of its inbox.
+    Outputs with expected values are checked as they get them, a row
+    stops on its first mismatch like a VM run stopping on mismatches.
+    '''
+
+    def __init__(self, vm, input_sets, output_sets=None, expected_sets=None):
+        if np is None:
+            raise BatchError("BatchVM requires numpy")
+        if len(input_sets) < 1:
+            raise BatchError("BatchVM needs at least one input set")
+
+        self.vm = vm
+        self.size = len(input_sets)
+        self.node_count = len(vm.nodes)
+        self.cycle = 0
+
+        B, N = self.size, self.node_count
+        self.acc = np.zeros((B, N), np.int64)
+        self.bak = np.zeros((B, N), np.int64)
+        self.nil = np.zeros((B, N), np.int64)
+        self.ip = np.zeros((B, N), np.int64)
+        self.state = np.zeros((B, N), np.int8)
+        self.blocked = np.zeros((B, N), bool)
+        self.waiting = np.zeros((B, N), bool)
+        self.halted = np.zeros((B, N), bool)
+        self.slot = np.zeros((B, N, len(PORTS_LIST)), np.int64)
+        self.full = np.zeros((B, N, len(PORTS_LIST)), bool)
+        self.regs = {REG_ACC: self.acc, REG_BAK: self.bak, REG_NIL: self.nil}
+
+        self.alive = np.ones(B, bool)
+        self.status = [RUN_RUNNING] * B
+        self.cycles = np.zeros(B, np.int64)
+        # first mismatch of every row, None while it has none
+        self.failed = np.zeros(B, bool)
+        self.mismatches = [None] * B
+
+        self._create_inputs(input_sets)
+        self._create_outputs(input_sets, output_sets, expected_sets)
+        self._compile()
+
+    @classmethod
+    def for_tests(cls, vm, tests):
+        '''A batch with a row for every test set, they must use the columns vm was loaded with'''
+        inputs = [node.id for node in vm.input_nodes]
+        outputs = [node.id for node in vm.output_nodes]
+        for test in tests:
+            if [i for i, values in enumerate(test.inputs) if values is not None] != inputs or \
+                    [i for i, values in enumerate(test.outputs) if values is not None] != outputs:
+                raise BatchError("The test sets do not all use the same I/O columns")
+        return cls(vm, [test.inputs for test in tests], [test.outputs for test in tests],
+                   [test.expected for test in tests])
+
+    # state
+
+    def _create_inputs(self, input_sets):
+        B = self.size
+        self.inputs = []
+        for node in self.vm.input_nodes:
+            lists = [list(inputs[node.id] or []) for inputs in input_sets]
+            width = max([len(values) for values in lists] + [1])
+            port = {
+                'id': node.id,
+                'values': np.zeros((B, width), np.int64),
+                'len': np.array([len(values) for values in lists], np.int64),
+                'ip': np.zeros(B, np.int64),
+                'end': np.zeros(B, bool),
+                'blocked': np.zeros(B, bool),
+                'state': np.zeros(B, np.int8),
+                'slot': np.zeros(B, np.int64),
+                'full': np.zeros(B, bool),
+            }
+            for row, values in enumerate(lists):
+                port['values'][row, :len(values)] = values
+            self.inputs.append(port)
+
+    def _create_outputs(self, input_sets, output_sets, expected_sets):
+        B = self.size
+        if output_sets is None:
+            output_sets = [self.vm.output_values] * B
+        if expected_sets is None:
+            expected_sets = [self.vm.expected_values] * B
+
+        def expected_of(row, column):
+            if column < len(expected_sets[row]):
+                return expected_sets[row][column]
+            return None
+
+        # the objectives of VM.objective: what a checked output expects, else
+        # the length of the first input when the row checks no output at all
+        checked = np.array([any(expected_of(row, node.id) is not None for node in self.vm.output_nodes)
+                            for row in range(B)], bool)
+        if len(self.vm.input_nodes) > 0:
+            fallback = np.array([len(inputs[self.vm.input_nodes[0].id] or [])
+                                 for inputs in input_sets], np.int64)
+        else:
+            # nothing to count the outputs against, the rows stop on a limit or a stall
+            fallback = np.full(B, -1, np.int64)
+        fallback[checked] = -1
+        self.outputs = []
+        for node in self.vm.output_nodes:
+            prefix = [list(outputs[node.id] or []) for outputs in output_sets]
+            expected = [expected_of(row, node.id) for row in range(B)]
+            lists = [list(values) if values is not None else [] for values in expected]
+            prefix_len = np.array([len(values) for values in prefix], np.int64)
+            expected_len = np.array([len(values) for values in lists], np.int64)
+            has = np.array([values is not None for values in expected], bool)
+            objective = np.where(has, prefix_len + expected_len, fallback)
+            width = int(max(objective.max(), prefix_len.max(), 0)) + 1
+            port = {
+                'id': node.id,
+                'values': np.zeros((B, width), np.int64),
+                'count': prefix_len.copy(),
+                'objective': objective,
+                'prefix': prefix_len,
+                'checked': has,
+                'expected': np.zeros((B, int(expected_len.max()) + 1), np.int64),
+                'expected_len': expected_len,
+                'blocked': np.zeros(B, bool),
+                'waiting': np.zeros(B, bool),
+                'state': np.zeros(B, np.int8),
+                'slot': np.zeros(B, np.int64),
+                'full': np.zeros(B, bool),
+            }
+            for row, values in enumerate(prefix):
+                port['values'][row, :len(values)] = values
+            for row, values in enumerate(lists):
+                port['expected'][row, :len(values)] = values
+            self.outputs.append(port)
+
+    # compilation
+
+    def _compile(self):
+        self.index = dict((node, n) for n, node in enumerate(self.vm.nodes))
+        for port in self.inputs:
+            self.index[self._input_node(port['id'])] = port
+        for node in self.vm.output_nodes:
+            # output nodes never offer a value to the grid
+            self.index[node] = None
+        self.programs = []
+        self.read_dirs = []
+        self.next_ips = []
+        for n, node in enumerate(self.vm.nodes):
+            size = min(len(node.instr), NODE_MAX_INSTR)
+            next_ips = [index + 1 if index + 1 < size else 0 for index in range(len(node.instr))]
+            read_dirs = []
+            program = []
+            for index, instr in enumerate(node.instr):
+                for reg in (instr.src if instr.src_type == SRC_TYPE_REG else None, instr.dest):
+                    if reg in (REG_ANY, REG_LAST):
+                        raise BatchError("ANY and LAST are not supported by BatchVM (node @%d)" % node.id)
+                if instr.src_type == SRC_TYPE_REG and instr.src in PORTS_LIST:
+                    read_dirs.append(instr.src)
+                else:
+                    read_dirs.append(-1)
+                program.append(self._compile_instr(n, index, instr, next_ips[index], size))
+            self.programs.append(program)
+            self.read_dirs.append(np.array(read_dirs or [-1], np.int64))
+            self.next_ips.append(np.array(next_ips or [0], np.int64))
+
+    def _input_node(self, _id):
+        for node in self.vm.input_nodes:
+            if node.id == _id:
+                return node
+
+    def _compile_instr(self, n, index, instr, next_ip, size):
+        regs = self.regs
+        acc = self.acc[:, n]
+        bak = self.bak[:, n]
+        ip = self.ip[:, n]
+        src = instr.src
+        dest = instr.dest
+        is_port = instr.src_type == SRC_TYPE_REG and src in PORTS_LIST
+
+        def done(sel, ip_value=next_ip):
+            self.state[sel, n] = NODE_STATE_RUN
+            ip[sel] = ip_value
+
+        def load(sel):
+            '''Returns the rows that got their source operand and its value'''
+            if is_port:
+                return self._read(n, src, sel)
+            if instr.src_type == SRC_TYPE_INT:
+                return sel, src
+            return sel, regs[src][:, n]
+
+        def finish_read(got):
+            if is_port:
+                self.blocked[got, n] = False
+
+        t = instr.type
+        if t == INSTR_MOV:
+            def op(sel):
+                got, value = load(sel)
+                if dest in PORTS_LIST:
+                    self._write(n, dest, got, value)
+                else:
+                    regs[dest][got, n] = value[got] if np.ndim(value) else value
+                    finish_read(got)
+                    done(got)
+        elif t in (INSTR_ADD, INSTR_SUB):
+            sign = 1 if t == INSTR_ADD else -1
+            def op(sel):
+                got, value = load(sel)
+                value = value[got] if np.ndim(value) else value
+                acc[got] = np.clip(acc[got] + sign * value, INT_MIN, INT_MAX)
+                finish_read(got)
+                done(got)
+        elif t == INSTR_NEG:
+            def op(sel):
+                acc[sel] = -acc[sel]
+                done(sel)
+        elif t == INSTR_SAV:
+            def op(sel):
+                bak[sel] = acc[sel]
+                done(sel)
+        elif t == INSTR_SWP:
+            def op(sel):
+                tmp = acc[sel]
+                acc[sel] = bak[sel]
+                bak[sel] = tmp
+                done(sel)
+        elif t == INSTR_JMP:
+            def op(sel):
+                done(sel, instr.target)
+        elif t in (INSTR_JEZ, INSTR_JNZ, INSTR_JGZ, INSTR_JLZ):
+            condition = {INSTR_JEZ: np.equal, INSTR_JNZ: np.not_equal,
+                         INSTR_JGZ: np.greater, INSTR_JLZ: np.less}[t]
+            def op(sel):
+                taken = sel & condition(acc, 0)
+                done(sel)
+                ip[taken] = instr.target
+        elif t == INSTR_JRO:
+            def op(sel):
+                if instr.src_type == SRC_TYPE_INT:
+                    done(sel, instr.target)
+                    return
+                got, value = load(sel)
+                finish_read(got)
+                done(got, np.clip(index + value[got], 0, size - 1))
+        elif t == INSTR_HCF:
+            def op(sel):
+                self.halted[sel, n] = True
+                done(sel)
+        elif t == INSTR_NOP:
+            def op(sel):
+                done(sel)
+        else:
+            raise BatchError('Unknown opcode %s' % t)
+        return op
+
+    # mailbox protocol, mirrors BasicExecutionNode.read_from and write
+
+    def _read(self, n, src, sel):
+        self.blocked[sel, n] = True
+        self.state[sel, n] = NODE_STATE_READ
+        got = sel & self.full[:, n, src]
+        value = self.slot[:, n, src].copy()
+        self.full[got, n, src] = False
+        self.waiting[sel & ~got, n] = True
+        return got, value
+
+    def _write(self, n, dest, sel, value):
+        self.blocked[sel, n] = True
+        self.state[sel, n] = NODE_STATE_WRITE
+        self.slot[sel, n, dest] = value[sel] if np.ndim(value) else value
+        self.full[sel, n, dest] = True
+
+    def _offered(self, writer, direction):
+        '''Rows where a writer offers a value towards direction'''
+        if writer is None:
+            return np.zeros(self.size, bool)
+        if isinstance(writer, dict):
+            return writer['blocked'] & writer['full']
+        opp_dir = OPPOSITE_PORT[direction]
+        return self.blocked[:, writer] & self.full[:, writer, opp_dir]
+
+    def _take(self, writer, direction, want):
+        '''Accepts the value a writer offers towards direction, like Mailbox.accept'''
+        if writer is None:
+            return want & False, np.zeros(self.size, np.int64)
+        got = want & self._offered(writer, direction)
+        if isinstance(writer, dict):
+            value = writer['slot'].copy()
+            writer['full'][got] = False
+            writer['blocked'][got] = False
+            writer['state'][got] = NODE_STATE_IDLE
+            writer['ip'][got] += 1
+            writer['end'][got & (writer['ip'] > writer['len'] - 1)] = True
+            return got, value
+        m = writer
+        opp_dir = OPPOSITE_PORT[direction]
+        value = self.slot[:, m, opp_dir].copy()
+        self.full[got, m, opp_dir] = False
+        self.blocked[got, m] = False
+        self.state[got, m] = NODE_STATE_IDLE
+        ip = self.ip[:, m]
+        ip[got] = self.next_ips[m][ip[got]]
+        return got, value
+
+    # cycle phases
+
+    def resolve(self):
+        alive = self.alive
+        for n, node in enumerate(self.vm.nodes):
+            if not self.programs[n]:
+                continue
+            want = alive & self.waiting[:, n]
+            if not want.any():
+                continue
+            read_dir = self.read_dirs[n][self.ip[:, n]]
+            for direction in PORTS_LIST:
+                sel = want & (read_dir == direction)
+                if not sel.any():
+                    continue
+                neighbor = node.inbox[direction].writer
+                if neighbor is None:
+                    # nothing ever writes to this mailbox, the rows stay blocked
+                    continue
+                got, value = self._take(self.index[neighbor], direction, sel)
+                self.slot[got, n, direction] = value[got]
+                self.full[got, n, direction] = True
+                self.blocked[got, n] = False
+                self.waiting[got, n] = False
+                self.state[got, n] = NODE_STATE_IDLE
+
+        for port, node in zip(self.outputs, self.vm.output_nodes):
+            want = alive & port['waiting']
+            if not want.any():
+                continue
+            got, value = self._take(self.index.get(node.inbox[node.port].writer), node.port, want)
+            port['slot'][got] = value[got]
+            port['full'][got] = True
+            port['blocked'][got] = False
+            port['waiting'][got] = False
+            port['state'][got] = NODE_STATE_IDLE
+
+    def step_cycle(self):
+        rows = np.arange(self.size)
+        alive = self.alive
+        for port in self.inputs:
+            sel = alive & ~port['blocked'] & ~port['end'] & (port['len'] > 0)
+            if sel.any():
+                width = port['values'].shape[1]
+                value = port['values'][rows, np.minimum(port['ip'], width - 1)]
+                port['blocked'][sel] = True
+                port['state'][sel] = NODE_STATE_WRITE
+                port['slot'][sel] = value[sel]
+                port['full'][sel] = True
+
+        for n, program in enumerate(self.programs):
+            if not program:
+                continue
+            runnable = alive & ~self.blocked[:, n]
+            if not runnable.any():
+                continue
+            ip = self.ip[:, n].copy()
+            for index, op in enumerate(program):
+                sel = runnable & (ip == index)
+                if sel.any():
+                    op(sel)
+
+        for port in self.outputs:
+            sel = alive & ~port['blocked']
+            if not sel.any():
+                continue
+            port['blocked'][sel] = True
+            port['state'][sel] = NODE_STATE_READ
+            got = sel & port['full']
+            port['waiting'][sel & ~got] = True
+            if got.any():
+                port['full'][got] = False
+                count = port['count']
+                if count.max() >= port['values'].shape[1]:
+                    port['values'] = np.hstack([port['values'], np.zeros_like(port['values'])])
+                port['values'][rows[got], count[got]] = port['slot'][got]
+                self._check(port, got)
+                count[got] += 1
+                port['blocked'][got] = False
+
+    def _check(self, port, got):
+        '''Compares the value the got rows of an output just received with the expected one'''
+        sel = got & port['checked']
+        if not sel.any():
+            return
+        rows = np.arange(self.size)
+        index = port['count'] - port['prefix']
+        past = index >= port['expected_len']
+        expected = port['expected'][rows, np.minimum(index, port['expected'].shape[1] - 1)]
+        value = port['values'][rows, port['count']]
+        wrong = sel & (past | (value != expected)) & ~self.failed
+        for row in np.nonzero(wrong)[0]:
+            self.mismatches[row] = {'output': port['id'], 'index': int(index[row]),
+                                    'value': int(value[row]),
+                                    'expected': None if past[row] else int(expected[row])}
+        self.failed |= wrong
+
+    def stalled(self):
+        '''Rows where no node can make progress anymore, like Scheduler.stalled'''
+        stalled = self.alive.copy()
+        for n, program in enumerate(self.programs):
+            if program:
+                stalled &= self.blocked[:, n]
+        for port in self.inputs:
+            stalled &= port['blocked'] | port['end'] | (port['len'] < 1)
+        for port in self.outputs:
+            stalled &= port['blocked']
+        if not stalled.any():
+            return stalled
+        # a transfer the next resolve runs is still progress
+        for n, node in enumerate(self.vm.nodes):
+            if not self.programs[n]:
+                continue
+            read_dir = self.read_dirs[n][self.ip[:, n]]
+            for direction in PORTS_LIST:
+                neighbor = node.inbox[direction].writer
+                if neighbor is not None:
+                    stalled &= ~(self.waiting[:, n] & (read_dir == direction) &
+                                 self._offered(self.index[neighbor], direction))
+        for port, node in zip(self.outputs, self.vm.output_nodes):
+            stalled &= ~(port['waiting'] &
+                         self._offered(self.index.get(node.inbox[node.port].writer), node.port))
+        return stalled
+
+    def drained(self):
+        '''Rows with an output not waited for that sent every input value, like Scheduler.drained'''
+        drained = np.ones(self.size, bool)
+        unknown = np.zeros(self.size, bool)
+        for port in self.outputs:
+            has = port['objective'] >= 0
+            drained &= ~has | (port['count'] >= port['objective'])
+            unknown |= ~has
+        drained &= unknown
+        for port in self.inputs:
+            drained &= port['end'] | (port['len'] < 1)
+        return drained
+
+    def _stop(self, rows, status):
+        for row in np.nonzero(rows & self.alive)[0]:
+            self.status[row] = status
+            self.cycles[row] = self.cycle
+        self.alive &= ~rows
+
+    def step(self):
+        self.cycle += 1
+        self.resolve()
+        self.step_cycle()
+
+        # a wrong value ends the row whatever else happened this cycle
+        self._stop(self.failed, RUN_MISMATCH)
+        self._stop(self.halted.any(axis=1), RUN_HALTED)
+        # a row completes once every output with an objective reached it
+        done = self.alive.copy()
+        waited = np.zeros(self.size, bool)
+        for port in self.outputs:
+            has = port['objective'] >= 0
+            done &= ~has | (port['count'] >= port['objective'])
+            waited |= has
+        self._stop(done & waited, RUN_COMPLETED)
+        stalled = self.stalled()
+        self._stop(stalled & self.drained(), RUN_COMPLETED)
+        self._stop(stalled, RUN_DEADLOCK)
+        return not self.alive.any()
+
+    def run(self, max_cycles=None, time_budget=None):
+        deadline = None
+        if time_budget is not None:
+            deadline = time.time() + time_budget
+        while max_cycles is None or self.cycle < max_cycles:
+            if self.step():
+                break
+            if deadline is not None and self.cycle % CLOCK_CHECK_INTERVAL == 0 \
+                    and time.time() > deadline:
+                self._stop(self.alive, RUN_TIMEOUT)
+                break
+        self._stop(self.alive, RUN_CYCLE_LIMIT)
+        return self.results()
+
+    def results(self):
+        results = []
+        for row in range(self.size):
+            outputs = {}
+            for port in self.outputs:
+                outputs[port['id']] = port['values'][row, :port['count'][row]].tolist()
+            passed = self.status[row] == RUN_COMPLETED
+            if passed and not any(port['checked'][row] for port in self.outputs):
+                # completed, but no output had expected values to check
+                passed = None
+            mismatches = [self.mismatches[row]] if self.mismatches[row] is not None else []
+            results.append({
+                'status': self.status[row],
+                'cycles': int(self.cycles[row]) if self.status[row] != RUN_RUNNING else self.cycle,
+                'outputs': outputs,
+                'mismatches': mismatches,
+                'mismatch_count': len(mismatches),
+                'passed': passed,
+            })
+        return results
@@ -0,0 +1,104 @@
+import sys, json, time, resource, multiprocessing
+from VM import VM
+from Scheduler import SCHEDULERS
+from BatchRunner import find_jobs
+
+# sample programs and the synthetic stress programs
+BENCH_PATHS = ['scripts', 'scripts/bench']
+BENCH_CYCLES = 20000
+# best of this many runs, the first one also pays the imports and caches
+BENCH_REPEAT = 3
+# how much worse than the baseline a number may get before it is flagged
+TOLERANCE = 0.25
+# shorter runs and parse time differences are mostly noise
+MIN_TIMED_CYCLES = 1000
+PARSE_NOISE = 0.001
+
+def bench_job(job, scheduler, cycles=BENCH_CYCLES, codegen=False, repeat=BENCH_REPEAT):
+    '''Loads and runs one program, returns its parse time, speed and peak memory.
+
+    Meant to run in a process of its own, the peak resident size is the
+    one of the whole process.
+    '''
+    tis, fixture = job
+    parse_seconds = run_seconds = None
+    for i in range(repeat):
+        vm = VM(codegen=codegen)
+        start = time.time()
+        vm.load(tis, fixture)
+        loaded = time.time()
+        result = vm.run(scheduler, cycles)
+        done = time.time()
+        parse_seconds = min(parse_seconds, loaded - start) if parse_seconds is not None else loaded - start
+        run_seconds = min(run_seconds, done - loaded) if run_seconds is not None else done - loaded
+    return {'tis': tis, 'fixture': fixture, 'scheduler': scheduler, 'codegen': codegen,
+            'status': result['status'], 'cycles': result['cycles'],
+            'parse_seconds': round(parse_seconds, 6),
+            'cycles_per_second': round(result['cycles'] / run_seconds, 1) if run_seconds > 0 else 0.0,
+            'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def find_benchmarks(paths=None):
+    jobs = []
+    for path in paths or BENCH_PATHS:
+        jobs.extend(find_jobs(path))
+    return jobs
+
+def run_benchmarks(jobs, schedulers=None, cycles=BENCH_CYCLES, codegen=False, repeat=BENCH_REPEAT):
+    '''Runs every job on every scheduler, one at a time and each in a fresh process'''
+    records = []
+    for job in jobs:
+        for scheduler in schedulers or sorted(SCHEDULERS):
+            pool = multiprocessing.Pool(1)
+            try:
+                records.append(pool.apply(bench_job, (job, scheduler, cycles, codegen, repeat)))
+            except Exception as e:
+                records.append({'tis': job[0], 'fixture': job[1], 'scheduler': scheduler,
+                                'codegen': codegen, 'status': 'error',
+                                'error': "%s: %s" % (type(e).__name__, e)})
+            finally:
+                pool.terminate()
+                pool.join()
+    return records
+
+def bench_key(record):
+    return (record['tis'], record['scheduler'], record['codegen'])
+
+def compare(records, baseline, tolerance=TOLERANCE):
+    '''Returns the numbers that got worse than the baseline by more than tolerance'''
+    base = dict((bench_key(record), record) for record in baseline['results'])
+    regressions = []
+    for record in records:
+        old = base.get(bench_key(record))
+        if old is None or 'cycles_per_second' not in record or 'cycles_per_second' not in old:
+            continue
+        worse = {}
+        if min(record['cycles'], old['cycles']) >= MIN_TIMED_CYCLES:
+            worse['cycles_per_second'] = \
+                record['cycles_per_second'] < old['cycles_per_second'] * (1 - tolerance)
+        worse['parse_seconds'] = \
+            record['parse_seconds'] > old['parse_seconds'] * (1 + tolerance) + PARSE_NOISE
+        worse['peak_kb'] = record['peak_kb'] > old['peak_kb'] * (1 + tolerance)
+        for field in sorted(worse):
+            if worse[field]:
+                regressions.append({'tis': record['tis'], 'scheduler': record['scheduler'],
+                                    'codegen': record['codegen'], 'field': field,
+                                    'baseline': old[field], 'value': record[field]})
+    return regressions
+
+def read_baseline(filename):
+    f = open(filename, 'r')
+    baseline = json.load(f)
+    f.close()
+    return baseline
+
+def write_baseline(records, filename, cycles=BENCH_CYCLES):
+    f = open(filename, 'w')
+    json.dump({'cycles': cycles, 'python': sys.version.split()[0], 'results': records}, f, indent=2)
+    f.close()
+
+def format_record(record):
+    if 'cycles_per_second' not in record:
+        return '%-40s %-9s %s' % (record['tis'], record['scheduler'], record.get('error'))
+    return '%-40s %-9s %8d cycles %10.0f cycles/s %8.2f ms parse %8d kB' % (
+        record['tis'], record['scheduler'], record['cycles'], record['cycles_per_second'],
+        record['parse_seconds'] * 1000, record['peak_kb'])
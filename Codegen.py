@@ -0,0 +1,282 @@
+from Enums import *
+
+# bind functions of the programs generated so far, keyed by program
+_programs = {}
+MAX_PROGRAMS = 4096
+
+READ_STATE = [
+    "value = regs[%(src)d]",
+    "if value is None:",
+    "    self.blocked = True",
+    "    self.state = %d" % NODE_STATE_READ,
+    "    inbox[%(src)d].wait()",
+    "    return",
+    "regs[%(src)d] = None",
+]
+WRITE = [
+    "self.blocked = True",
+    "self.state = %d" % NODE_STATE_WRITE,
+    "outbox[%(dest)d].offer(%(value)s)",
+]
+NEXT = [
+    "self.state = %d" % NODE_STATE_RUN,
+    "self.ip = %(next_ip)d",
+]
+CLAMP = [
+    "if acc > %d:" % INT_MAX,
+    "    acc = %d" % INT_MAX,
+    "elif acc < %d:" % INT_MIN,
+    "    acc = %d" % INT_MIN,
+    "regs[%d] = acc" % REG_ACC,
+]
+JRO = [
+    "ip = self.ip + %(offset)s",
+    "if ip > %(last)d:",
+    "    ip = %(last)d",
+    "elif ip < 0:",
+    "    ip = 0",
+    "self.ip = ip",
+    "self.state = %d" % NODE_STATE_RUN,
+]
+CONDITIONS = {
+    INSTR_JEZ: '==',
+    INSTR_JNZ: '!=',
+    INSTR_JGZ: '>',
+    INSTR_JLZ: '<',
+}
+
+class Codegen(object):
+    '''Generates the Python source of a node program.
+
+    Each instruction becomes one function with its registers, constants,
+    jump targets and clamping written out, following the same mailbox
+    protocol as the closures of BasicExecutionNode. The functions are
+    nested in a bind(self, regs) function returning them in ip order, and
+    bind is cached by program so every node running the same code only
+    has to call it.
+    '''
+
+    def __init__(self, instructions):
+        self.instr = instructions
+        self.size = min(len(instructions), NODE_MAX_INSTR)
+
+    @staticmethod
+    def key(instructions):
+        return tuple((instr.type, instr.src, instr.dest, instr.src_type, instr.target)
+                     for instr in instructions)
+
+    def source(self):
+        lines = ["def bind(self, regs):",
+                 "    inbox = self.inbox",
+                 "    outbox = self.outbox"]
+        for index, instr in enumerate(self.instr):
+            next_ip = index + 1
+            if next_ip > NODE_MAX_INSTR - 1 or next_ip > len(self.instr) - 1:
+                next_ip = 0
+            generator = self.GENERATORS.get(instr.type)
+            if generator is None:
+                raise Exception('Unknown opcode %s' % instr.type)
+            fields = {'next_ip': next_ip, 'src': instr.src, 'dest': instr.dest,
+                      'target': instr.target, 'last': self.size - 1}
+            lines.append("    def i%d():" % index)
+            lines.append("        # %r" % instr)
+            for line in generator(self, instr, next_ip):
+                lines.append("        " + line % fields)
+        lines.append("    return [%s]" % ', '.join('i%d' % index for index in range(len(self.instr))))
+        return '\n'.join(lines) + '\n'
+
+    def _gen_mov(self, instr, next_ip):
+        if instr.src_type == SRC_TYPE_INT:
+            value = '%d' % instr.src
+            if instr.dest in PORTS_LIST:
+                return [line.replace('%(value)s', value) for line in WRITE]
+            return ["regs[%%(dest)d] = %s" % value] + NEXT
+        if instr.src in PORT_REGISTERS:
+            if instr.dest in PORTS_LIST:
+                return READ_STATE + [line.replace('%(value)s', 'value') for line in WRITE]
+            return READ_STATE + ["regs[%(dest)d] = value"] + NEXT
+        if instr.dest in PORTS_LIST:
+            return [line.replace('%(value)s', 'regs[%(src)d]') for line in WRITE]
+        return ["regs[%(dest)d] = regs[%(src)d]"] + NEXT
+
+    def _gen_add(self, instr, next_ip):
+        return self._gen_arith(instr, '+')
+
+    def _gen_sub(self, instr, next_ip):
+        return self._gen_arith(instr, '-')
+
+    def _gen_arith(self, instr, sign):
+        acc = "acc = regs[%d] %s " % (REG_ACC, sign)
+        if instr.src_type == SRC_TYPE_REG and instr.src in PORT_REGISTERS:
+            return READ_STATE + [acc + "value"] + CLAMP + NEXT
+        elif instr.src_type == SRC_TYPE_REG:
+            return [acc + "regs[%(src)d]"] + CLAMP + NEXT
+        elif instr.src_type == SRC_TYPE_INT:
+            return [acc + "%d" % instr.src] + CLAMP + NEXT
+        raise Exception()
+
+    def _gen_neg(self, instr, next_ip):
+        return ["regs[%d] = -regs[%d]" % (REG_ACC, REG_ACC)] + NEXT
+
+    def _gen_sav(self, instr, next_ip):
+        return ["regs[%d] = regs[%d]" % (REG_BAK, REG_ACC)] + NEXT
+
+    def _gen_swp(self, instr, next_ip):
+        return ["regs[%d], regs[%d] = regs[%d], regs[%d]" % (REG_ACC, REG_BAK, REG_BAK, REG_ACC)] + NEXT
+
+    def _gen_jmp(self, instr, next_ip):
+        return ["self.ip = %(target)d", "self.state = %d" % NODE_STATE_RUN]
+
+    def _gen_jump(self, instr, next_ip):
+        if instr.target == next_ip:
+            # both branches land on the next instruction
+            return self._gen_jmp(instr, next_ip)
+        test = "regs[%d] %s 0" % (REG_ACC, CONDITIONS[instr.type])
+        return ["self.ip = %%(target)d if %s else %%(next_ip)d" % test,
+                "self.state = %d" % NODE_STATE_RUN]
+
+    def _gen_jro(self, instr, next_ip):
+        if instr.src_type == SRC_TYPE_INT:
+            return ["self.ip = %(target)d", "self.state = %d" % NODE_STATE_RUN]
+        elif instr.src in PORT_REGISTERS:
+            return READ_STATE + [line.replace('%(offset)s', 'value') for line in JRO]
+        elif instr.src_type == SRC_TYPE_REG:
+            return [line.replace('%(offset)s', 'regs[%(src)d]') for line in JRO]
+        raise Exception()
+
+    def _gen_hcf(self, instr, next_ip):
+        return ["self.halted = True"] + NEXT
+
+    def _gen_nop(self, instr, next_ip):
+        return NEXT
+
+
+Codegen.GENERATORS = {
+    INSTR_MOV: Codegen._gen_mov,
+    INSTR_ADD: Codegen._gen_add,
+    INSTR_SUB: Codegen._gen_sub,
+    INSTR_NEG: Codegen._gen_neg,
+    INSTR_SAV: Codegen._gen_sav,
+    INSTR_SWP: Codegen._gen_swp,
+    INSTR_JMP: Codegen._gen_jmp,
+    INSTR_JEZ: Codegen._gen_jump,
+    INSTR_JNZ: Codegen._gen_jump,
+    INSTR_JGZ: Codegen._gen_jump,
+    INSTR_JLZ: Codegen._gen_jump,
+    INSTR_JRO: Codegen._gen_jro,
+    INSTR_HCF: Codegen._gen_hcf,
+    INSTR_NOP: Codegen._gen_nop,
+}
+
+
+def generate_program(node):
+    '''Returns the generated instruction functions of a node, bound to it'''
+    key = Codegen.key(node.instr)
+    bind = _programs.get(key)
+    if bind is None:
+        namespace = {}
+        code = compile(Codegen(node.instr).source(), '<tis node program>', 'exec')
+        exec code in namespace
+        bind = namespace['bind']
+        if len(_programs) >= MAX_PROGRAMS:
+            _programs.clear()
+        _programs[key] = bind
+    return bind(node, node.regs)
+
+
+# cycle functions of the grids generated so far, keyed by source
+_grids = {}
+
+class GridCodegen(object):
+    '''Generates one function running a whole lockstep cycle of a grid.
+
+    The cycle resolves the ready mailboxes, then runs the cycle of every
+    active node in lockstep order, with the input and output nodes
+    written out against their own mailbox. Nodes without code are left
+    out, the scheduler brings their cycle_count up to date. The function
+    returns the run status once the grid stops.
+    '''
+
+    def __init__(self, vm):
+        self.inputs = list(vm.input_nodes)
+        self.nodes = [node for node in vm.nodes if len(node.program) > 0]
+        self.outputs = list(vm.output_nodes)
+        self.objects = self.inputs + self.nodes + self.outputs
+        self.names = dict((id(node), index) for index, node in enumerate(self.objects))
+
+    def name(self, node):
+        return 'n%d' % self.names[id(node)]
+
+    def source(self):
+        lines = ["def bind(objects, switchboard):",
+                 "    resolve = switchboard.resolve"]
+        if len(self.objects) > 0:
+            lines.append("    [%s] = objects" % ', '.join(self.name(node) for node in self.objects))
+        for node in self.nodes + self.outputs:
+            lines.append("    r%s = %s.regs" % (self.name(node)[1:], self.name(node)))
+        for node in self.inputs:
+            lines.append("    b%s = %s.outbox[%d]" % (self.name(node)[1:], self.name(node), node.port))
+        for node in self.outputs:
+            lines.append("    b%s = %s.inbox[%d]" % (self.name(node)[1:], self.name(node), node.port))
+        for node in self.nodes:
+            name = self.name(node)
+            lines.append("    p%s = %s.program" % (name[1:], name))
+        lines.append("    def cycle():")
+        body = ["resolve()"]
+        for node in self.inputs:
+            body += self.cycle_input(node)
+        for node in self.nodes:
+            body += ["if not %s.blocked:" % self.name(node),
+                     "    p%s[%s.ip]()" % (self.name(node)[1:], self.name(node))]
+        for node in self.outputs:
+            body += self.cycle_output(node)
+        for node in self.nodes:
+            if any(instr.type == INSTR_HCF for instr in node.instr):
+                body += ["if %s.halted:" % self.name(node),
+                         "    return %r" % RUN_HALTED]
+        # the run completes once every output with an objective reached it
+        objectives = ["len(%s.values) >= %s.len_objective" % (self.name(node), self.name(node))
+                      for node in self.outputs if node.len_objective is not None]
+        if len(objectives) > 0:
+            body += ["if %s:" % ' and '.join(objectives),
+                     "    return %r" % RUN_COMPLETED]
+        body.append("return None")
+        lines += ["        " + line for line in body]
+        lines.append("    return cycle")
+        return '\n'.join(lines) + '\n'
+
+    def cycle_input(self, node):
+        name = self.name(node)
+        return ["if len(%s.values) > 0 and not %s.blocked and not %s.end_reached:" % (name, name, name),
+                "    %s.blocked = True" % name,
+                "    %s.state = %d" % (name, NODE_STATE_WRITE),
+                "    b%s.offer(%s.values[%s.ip])" % (name[1:], name, name)]
+
+    def cycle_output(self, node):
+        name = self.name(node)
+        src = node.port
+        return ["if not %s.blocked:" % name,
+                "    value = r%s[%d]" % (name[1:], src),
+                "    if value is None:",
+                "        %s.blocked = True" % name,
+                "        %s.state = %d" % (name, NODE_STATE_READ),
+                "        b%s.wait()" % name[1:],
+                "    else:",
+                "        r%s[%d] = None" % (name[1:], src),
+                "        %s.values.append(value)" % name,
+                "        %s.state = %d" % (name, NODE_STATE_READ)]
+
+
+def generate_grid(vm):
+    '''Returns a function running one lockstep cycle of the loaded grid'''
+    generator = GridCodegen(vm)
+    source = generator.source()
+    bind = _grids.get(source)
+    if bind is None:
+        namespace = {}
+        exec compile(source, '<tis grid cycle>', 'exec') in namespace
+        bind = namespace['bind']
+        if len(_grids) >= MAX_PROGRAMS:
+            _grids.clear()
+        _grids[source] = bind
+    return bind(generator.objects, vm.switchboard)
@@ -0,0 +1,108 @@
+import os, errno, time, marshal, hashlib, tempfile
+
+# bump whenever parsing, linking or the instruction image changes
+ENGINE_VERSION = 1
+
+class CompileCache(object):
+    '''On-disk cache of parsed and linked node programs.
+
+    Entries are keyed by a hash of the node source block and ENGINE_VERSION
+    and hold the marshalled node image. They are written to a temporary
+    file and renamed in place, so concurrent workers only ever read whole
+    entries. A hit refreshes the entry mtime and the least recently used
+    entries are evicted once the cache grows past max_size bytes.
+    '''
+
+    PRUNE_INTERVAL = 64
+
+    def __init__(self, path, max_size=64 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def key(source_lines):
+        digest = hashlib.sha1('%d\0' % ENGINE_VERSION)
+        digest.update('\n'.join(source_lines))
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.bin')
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            image = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            # a damaged entry is dropped and compiled again
+            image = None
+        f.close()
+        if image is None:
+            self._remove(filename)
+            self.misses += 1
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return image
+
+    def put(self, key, image):
+        fd, tmp_filename = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            marshal.dump(image, f)
+            f.close()
+            os.rename(tmp_filename, self.filename(key))
+        except Exception:
+            self._remove(tmp_filename)
+            raise
+        if self.puts % self.PRUNE_INTERVAL == 0:
+            self.prune()
+        self.puts += 1
+
+    def prune(self):
+        '''Evicts the least recently used entries down to 90% of max_size'''
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                # left over by a worker that died while writing
+                if now - stat.st_mtime > 60:
+                    self._remove(filename)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for mtime, size, filename in entries:
+            if total <= self.max_size * 0.9:
+                break
+            self._remove(filename)
+            total -= size
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
@@ -0,0 +1,113 @@
+from Enums import *
+
+class NodeCounters(object):
+    '''Cycles of one node by instruction address.
+
+    executed counts the cycles an instruction ran in, a write counting on
+    the cycle it offers its value. The cycles spent waiting on a port go
+    to read_stalls or write_stalls of the instruction that waits, so
+    together they add up to the cycles the node spent on each line.
+    '''
+
+    __slots__ = ('node', 'executed', 'read_stalls', 'write_stalls', 'pending')
+
+    def __init__(self, node):
+        self.node = node
+        size = len(node.instr)
+        self.executed = [0] * size
+        self.read_stalls = [0] * size
+        self.write_stalls = [0] * size
+        # cycle, state and ip of the port instruction the node waits on
+        self.pending = None
+
+    def close(self, cycle):
+        '''Counts the cycles the node did not run in since its last block'''
+        start, state, ip = self.pending
+        self.pending = None
+        if state == NODE_STATE_READ:
+            self.read_stalls[ip] += cycle - start
+        else:
+            self.write_stalls[ip] += cycle - start
+
+    def report(self, cycles):
+        executed = sum(self.executed)
+        read_stalls = sum(self.read_stalls)
+        write_stalls = sum(self.write_stalls)
+        opcodes = {}
+        for instr, count in zip(self.node.instr, self.executed):
+            if count > 0:
+                name = INSTRUCTION_NAMES[instr.type]
+                opcodes[name] = opcodes.get(name, 0) + count
+        return {'node': self.node.id, 'cycles': cycles, 'executed': executed,
+                'read_stalls': read_stalls, 'write_stalls': write_stalls,
+                'idle': cycles - executed - read_stalls - write_stalls,
+                'utilization': float(executed) / cycles if cycles > 0 else 0.0,
+                'opcodes': opcodes}
+
+
+class Counters(object):
+    '''Performance counters of the nodes with code during one run.
+
+    attach wraps every instruction function of those nodes in place, so
+    the schedulers and the generated grid cycle count through the same
+    calls they make anyway. A node blocked on a port is not called until
+    its mailbox resolves, the cycles it waited are added up when it runs
+    again or when the run ends.
+    '''
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.nodes = [NodeCounters(node) for node in vm.nodes if len(node.program) > 0]
+        self.programs = []
+
+    def attach(self):
+        for counters in self.nodes:
+            program = counters.node.program
+            self.programs.append(program[:])
+            program[:] = [self.counted(counters, ip, op) for ip, op in enumerate(program)]
+
+    def detach(self):
+        cycle = self.vm.cycle
+        for counters, program in zip(self.nodes, self.programs):
+            counters.node.program[:] = program
+            if counters.pending is not None:
+                counters.close(cycle)
+        self.programs = []
+
+    def counted(self, counters, ip, op):
+        vm = self.vm
+        node = counters.node
+        executed = counters.executed
+        read_stalls = counters.read_stalls
+
+        def run():
+            cycle = vm.cycle
+            if counters.pending is not None:
+                counters.close(cycle - 1)
+            op()
+            if node.blocked:
+                counters.pending = (cycle, node.state, ip)
+                if node.state == NODE_STATE_READ:
+                    read_stalls[ip] += 1
+                    return
+            executed[ip] += 1
+        return run
+
+    def report(self):
+        cycles = self.vm.cycle
+        nodes = [counters.report(cycles) for counters in self.nodes]
+        total = {'cycles': cycles * len(nodes), 'opcodes': {}}
+        for key in ('executed', 'read_stalls', 'write_stalls', 'idle'):
+            total[key] = sum(node[key] for node in nodes)
+        for node in nodes:
+            for name, count in node['opcodes'].iteritems():
+                total['opcodes'][name] = total['opcodes'].get(name, 0) + count
+        total['utilization'] = float(total['executed']) / total['cycles'] if total['cycles'] > 0 else 0.0
+        return {'nodes': nodes, 'total': total}
+
+
+def score(vm):
+    '''The TIS-100 score of the loaded program: cycles, nodes and instructions'''
+    used = [node for node in vm.nodes if len(node.instr) > 0]
+    return {'cycles': vm.cycle, 'nodes': len(used),
+            'instructions': sum(len(node.instr) for node in used)}
@@ -1,34 +1,47 @@
-
-REG_ACC   = 'ACC'
-REG_BAK   = 'BAK'
-REG_NIL   = 'NIL'
-REG_LEFT  = 'LEFT'
-REG_RIGHT = 'RIGHT'
-REG_UP    = 'UP'
-REG_DOWN  = 'DOWN'
-REG_ANY   = 'ANY'
-REG_LAST  = 'LAST'
+# registers, the four ports come first so their codes can index port arrays
+REG_LEFT  = 0
+REG_RIGHT = 1
+REG_UP    = 2
+REG_DOWN  = 3
+REG_ACC   = 4
+REG_BAK   = 5
+REG_NIL   = 6
+REG_ANY   = 7
+REG_LAST  = 8
+
+REGISTER_NAMES = [
+    'LEFT', 'RIGHT', 'UP', 'DOWN', 'ACC', 'BAK', 'NIL', 'ANY', 'LAST'
+]
+REGISTER_CODES = dict((name, code) for code, name in enumerate(REGISTER_NAMES))
 
 REGISTERS_SET = [
     REG_ACC, REG_BAK, REG_NIL, REG_LEFT, REG_RIGHT, REG_UP, REG_DOWN,
     REG_ANY, REG_LAST
 ]
-
-INSTR_NOP = 'NOP'
-INSTR_MOV = 'MOV'
-INSTR_SWP = 'SWP'
-INSTR_SAV = 'SAV'
-INSTR_ADD = 'ADD'
-INSTR_SUB = 'SUB'
-INSTR_NEG = 'NEG'
-INSTR_JMP = 'JMP'
-INSTR_JEZ = 'JEZ'
-INSTR_JNZ = 'JNZ'
-INSTR_JGZ = 'JGZ'
-INSTR_JLZ = 'JLZ'
-INSTR_JRO = 'JRO'
-INSTR_HCF = 'HCF'
-INSTR_LABEL = 'LABEL'
+REGISTERS_COUNT = len(REGISTER_NAMES)
+
+INSTR_NOP   = 0
+INSTR_MOV   = 1
+INSTR_SWP   = 2
+INSTR_SAV   = 3
+INSTR_ADD   = 4
+INSTR_SUB   = 5
+INSTR_NEG   = 6
+INSTR_JMP   = 7
+INSTR_JEZ   = 8
+INSTR_JNZ   = 9
+INSTR_JGZ   = 10
+INSTR_JLZ   = 11
+INSTR_JRO   = 12
+INSTR_HCF   = 13
+INSTR_LABEL = 14
+
+INSTRUCTION_NAMES = [
+    'NOP', 'MOV', 'SWP', 'SAV', 'ADD', 'SUB', 'NEG',
+    'JMP', 'JEZ', 'JNZ', 'JGZ', 'JLZ', 'JRO',
+    'HCF', 'LABEL'
+]
+INSTRUCTION_CODES = dict((name, code) for code, name in enumerate(INSTRUCTION_NAMES))
 
 INSTRUCTIONS_SET = [
     INSTR_NOP, INSTR_MOV, INSTR_SWP, INSTR_SAV, INSTR_ADD, INSTR_SUB, INSTR_NEG,
@@ -36,7 +49,7 @@ INSTRUCTIONS_SET = [
     INSTR_HCF, INSTR_LABEL
 ]
 
-TYPE_LABEL = 'LABEL'
+TYPE_LABEL = INSTR_LABEL
 
 SRC_TYPE_NONE  = 0
 SRC_TYPE_REG   = 1
@@ -50,6 +63,7 @@ NODE_MAX_INSTR = 15
 INT_MAX =  999
 INT_MIN = -999
 
+# default grid, a puzzle sets its own with TIS_WIDTH and TIS_HEIGHT
 WIDTH  = 4
 HEIGHT = 3
 
@@ -67,20 +81,38 @@ PORT_REGISTERS = [
     REG_LEFT, REG_RIGHT, REG_UP, REG_DOWN, REG_ANY, REG_LAST
 ]
 
-PORT_LEFT  = 'LEFT'
-PORT_RIGHT = 'RIGHT'
-PORT_UP    = 'UP'
-PORT_DOWN  = 'DOWN'
+# registers no neighbor can see
+LOCAL_REGISTERS = [REG_ACC, REG_BAK, REG_NIL]
+
+PORT_LEFT  = REG_LEFT
+PORT_RIGHT = REG_RIGHT
+PORT_UP    = REG_UP
+PORT_DOWN  = REG_DOWN
 
 PORTS_LIST = [
     PORT_LEFT, PORT_RIGHT, PORT_UP, PORT_DOWN
 ]
 
+OPPOSITE_PORT = [PORT_RIGHT, PORT_LEFT, PORT_DOWN, PORT_UP]
 
-# states
-NODE_STATE_IDLE  = 'IDLE'
-NODE_STATE_RUN   = 'RUN'
-NODE_STATE_READ  = 'READ'
-NODE_STATE_WRITE = 'WRTE'
 
-NODE_STATES = [NODE_STATE_IDLE, NODE_STATE_RUN, NODE_STATE_READ, NODE_STATE_WRITE]
\ No newline at end of file
+# states
+NODE_STATE_IDLE  = 0
+NODE_STATE_RUN   = 1
+NODE_STATE_READ  = 2
+NODE_STATE_WRITE = 3
+
+NODE_STATES = [NODE_STATE_IDLE, NODE_STATE_RUN, NODE_STATE_READ, NODE_STATE_WRITE]
+NODE_STATE_NAMES = ['IDLE', 'RUN', 'READ', 'WRTE']
+
+
+# run results
+RUN_RUNNING   = 'running'
+RUN_COMPLETED = 'completed'
+RUN_HALTED    = 'halted'
+RUN_ERROR     = 'error'
+RUN_TIMEOUT   = 'timeout'
+RUN_DEADLOCK  = 'deadlock'
+RUN_CYCLE_LIMIT = 'cycle_limit'
+RUN_LIVELOCK  = 'livelock'
+RUN_MISMATCH  = 'mismatch'
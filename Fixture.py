@@ -0,0 +1,243 @@
+import os, json, mmap, struct
+from Streams import VALUE, PackedValues
+from Enums import *
+
+FIXTURE_EXTENSION = '.tisf'
+FIXTURE_MAGIC = 'TISF'
+FIXTURE_VERSION = 1
+# looked for next to a .tis file, the fastest to load first
+FIXTURE_EXTENSIONS = [FIXTURE_EXTENSION, '.json']
+# the TIS_* attributes of a Python module, only read to convert them
+MODULE_EXTENSION = '.py'
+
+# magic, version, grid width and height (0 for the default), test sets
+HEADER = struct.Struct('<4sHHHI')
+# first value and count of a list of values
+LIST = struct.Struct('<II')
+NO_LIST = 0xffffffff
+# lists of a column in a test set: inputs, outputs, expected outputs
+COLUMN_LISTS = 3
+
+class FixtureError(Exception):
+    pass
+
+
+class TestSet(object):
+    '''Values of every column for one run of a puzzle.
+
+    inputs holds the values of every input, None where there is none.
+    outputs marks the outputs with the values they start with, usually
+    an empty list, and expected holds what they should get, None where
+    an output is not checked. The shorter ones are padded with None to
+    the same number of columns.
+    '''
+
+    __slots__ = ('inputs', 'outputs', 'expected')
+
+    def __init__(self, inputs, outputs, expected=None):
+        if expected is None:
+            expected = []
+        columns = max(len(inputs), len(outputs), len(expected))
+        self.inputs = pad_columns(inputs, columns)
+        self.outputs = pad_columns(outputs, columns)
+        self.expected = pad_columns(expected, columns)
+
+    def columns(self):
+        return zip(self.inputs, self.outputs, self.expected)
+
+
+class Fixture(object):
+    '''The test sets of a puzzle and the size of its grid'''
+
+    def __init__(self, tests, width=None, height=None):
+        # a list, or a sequence decoding every test set when asked for it
+        self.tests = tests
+        self.width = width
+        self.height = height
+
+    def __len__(self):
+        return len(self.tests)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self.tests):
+            raise FixtureError("No test set %d, the fixture has %d" % (index, len(self.tests)))
+        return self.tests[index]
+
+    def __iter__(self):
+        for index in range(len(self.tests)):
+            yield self.tests[index]
+
+
+class PackedTests(object):
+    '''Test sets of a packed fixture, decoded from its buffer one at a time'''
+
+    def __init__(self, data, count, columns):
+        self.data = data
+        self.count = count
+        self.columns = columns
+        self.values_offset = HEADER.size + count * columns * COLUMN_LISTS * LIST.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        offset = HEADER.size + index * self.columns * COLUMN_LISTS * LIST.size
+        lists = []
+        for i in range(self.columns * COLUMN_LISTS):
+            first, count = LIST.unpack_from(self.data, offset + i * LIST.size)
+            if count == NO_LIST:
+                lists.append(None)
+            else:
+                lists.append(PackedValues(self.data, self.values_offset + first * VALUE.size, count))
+        outputs = [list(values) if values is not None else None for values in lists[1::3]]
+        return TestSet(lists[0::3], outputs, lists[2::3])
+
+
+def pad_columns(lists, columns):
+    if len(lists) >= columns:
+        return lists
+    return list(lists) + [None] * (columns - len(lists))
+
+def find_fixture(tis_filename):
+    '''The fixture next to a .tis file, None without any'''
+    base = os.path.splitext(tis_filename)[0]
+    for extension in FIXTURE_EXTENSIONS:
+        if os.path.exists(base + extension):
+            return base + extension
+    return None
+
+def load_fixture(filename, modules=False):
+    '''Reads a fixture, a Python one only with modules as it runs its code'''
+    extension = os.path.splitext(filename)[1]
+    if extension == FIXTURE_EXTENSION:
+        return read_packed(filename)
+    if extension == '.json':
+        return read_json(filename)
+    if extension == MODULE_EXTENSION:
+        if not modules:
+            raise FixtureError("%s is Python code, convert it with --convert-fixture first" % filename)
+        return read_module(filename)
+    raise FixtureError("Unknown fixture format: %s" % filename)
+
+def read_module(filename):
+    '''Reads the TIS_* attributes of a Python fixture as its only test set'''
+    import imp
+    mod = imp.load_source(os.path.splitext(os.path.basename(filename))[0], filename)
+    width = getattr(mod, 'TIS_WIDTH', None)
+    height = getattr(mod, 'TIS_HEIGHT', None)
+    columns = range(width or WIDTH)
+    test = TestSet([getattr(mod, 'TIS_IN_%d' % i, None) for i in columns],
+                   [getattr(mod, 'TIS_OUT_%d' % i, None) for i in columns],
+                   [getattr(mod, 'TIS_EXPECTED_%d' % i, None) for i in columns])
+    return Fixture([test], width, height)
+
+def read_json(filename):
+    '''Reads a JSON fixture.
+
+    {"width": 4, "height": 3, "tests": [{"inputs": [...], "outputs": [...],
+    "expected": [...]}, ...]} with a list or null per column, the grid size
+    and the expected values being optional.
+    '''
+    f = open(filename, 'r')
+    try:
+        data = json.load(f)
+    except ValueError as e:
+        raise FixtureError("Invalid JSON fixture %s: %s" % (filename, e))
+    finally:
+        f.close()
+    if not isinstance(data, dict) or not isinstance(data.get('tests'), list):
+        raise FixtureError("No tests in fixture %s" % filename)
+    columns = data.get('width') or WIDTH
+    tests = []
+    for index, test in enumerate(data['tests']):
+        if 'inputs' not in test or 'outputs' not in test:
+            raise FixtureError("Test set without inputs or outputs in %s" % filename)
+        for key in ('inputs', 'outputs', 'expected'):
+            lists = test.get(key)
+            if lists is None and key == 'expected':
+                continue
+            if not isinstance(lists, list) or len(lists) != columns:
+                raise FixtureError("Test set %d of %s needs %d %s columns"
+                                   % (index, filename, columns, key))
+        tests.append(TestSet(test['inputs'], test['outputs'], test.get('expected')))
+    return Fixture(tests, data.get('width'), data.get('height'))
+
+def read_packed(filename):
+    '''Maps a packed fixture, its values stay in the file until a node reads them'''
+    f = open(filename, 'rb')
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        raise FixtureError("Empty fixture: %s" % filename)
+    finally:
+        f.close()
+    try:
+        magic, version, width, height, count = HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise FixtureError("Truncated fixture: %s" % filename)
+    if magic != FIXTURE_MAGIC:
+        raise FixtureError("Not a %s fixture: %s" % (FIXTURE_EXTENSION, filename))
+    if version != FIXTURE_VERSION:
+        raise FixtureError("Unsupported %s version %d" % (FIXTURE_EXTENSION, version))
+    columns = width or WIDTH
+    tests = PackedTests(data, count, columns)
+    if len(data) < tests.values_offset:
+        raise FixtureError("Truncated fixture: %s" % filename)
+    return Fixture(tests, width or None, height or None)
+
+def write_json(fixture, filename):
+    def plain(values):
+        return list(values) if values is not None else None
+    tests = [{'inputs': [plain(values) for values in test.inputs],
+              'outputs': [plain(values) for values in test.outputs],
+              'expected': [plain(values) for values in test.expected]} for test in fixture]
+    data = {'tests': tests}
+    if fixture.width is not None:
+        data['width'] = fixture.width
+    if fixture.height is not None:
+        data['height'] = fixture.height
+    f = open(filename, 'w')
+    json.dump(data, f)
+    f.close()
+
+def write_packed(fixture, filename):
+    '''Writes a packed fixture.
+
+    A header, then a table with the first value and count of the input,
+    output and expected lists of every column of every test set, then
+    all the values as VALUEs. A missing list has NO_LIST as count.
+    '''
+    columns = fixture.width or WIDTH
+    table = []
+    values = []
+    for test in fixture:
+        for column in range(columns):
+            for lst in test.columns()[column] if column < len(test.inputs) else (None,) * COLUMN_LISTS:
+                if lst is None:
+                    table.append(LIST.pack(0, NO_LIST))
+                else:
+                    lst = list(lst)
+                    table.append(LIST.pack(len(values), len(lst)))
+                    values.extend(lst)
+    try:
+        packed = struct.pack('<%dh' % len(values), *values)
+    except struct.error:
+        raise FixtureError("Fixture values must fit in 16 bits")
+    f = open(filename, 'wb')
+    f.write(HEADER.pack(FIXTURE_MAGIC, FIXTURE_VERSION, fixture.width or 0, fixture.height or 0,
+                        len(fixture)))
+    f.write(''.join(table))
+    f.write(packed)
+    f.close()
+
+def convert(source, dest):
+    '''Writes the fixture in source to dest, in the format of its extension.
+
+    The only way a Python fixture is read.
+    '''
+    fixture = load_fixture(source, modules=True)
+    if os.path.splitext(dest)[1] == FIXTURE_EXTENSION:
+        write_packed(fixture, dest)
+    else:
+        write_json(fixture, dest)
+    return fixture
@@ -0,0 +1,405 @@
+import os, time, random, multiprocessing
+from VM import VM
+from Scheduler import SCHEDULERS
+from BatchVM import BatchVM, BatchError
+from Fixture import Fixture, TestSet, write_json
+from Enums import *
+
+# cycles a case runs at most
+FUZZ_CYCLES = 300
+# the reference every other engine is compared with
+REFERENCE = ('lockstep', False)
+# checks a shrink may spend on one case
+MAX_SHRINK_CHECKS = 2000
+# the checked cases repeat up to CHECKED_PERIOD input values CHECKED_VALUES
+# times, long enough to fast-forward, and run CHECKED_CYCLES times longer
+CHECKED_VALUES = 120
+CHECKED_PERIOD = 3
+CHECKED_CYCLES = 4
+
+SOURCES = ['ACC', 'BAK', 'NIL', 'LEFT', 'RIGHT', 'UP', 'DOWN']
+DESTINATIONS = ['ACC', 'NIL', 'LEFT', 'RIGHT', 'UP', 'DOWN']
+JUMPS = ['JMP', 'JEZ', 'JNZ', 'JGZ', 'JLZ']
+
+class FuzzCase(object):
+    '''A program and its I/O, turned into VMs or a .tis file and its fixture'''
+
+    def __init__(self, programs, inputs, outputs, cycles=FUZZ_CYCLES, expected=None):
+        # source lines by node id
+        self.programs = programs
+        # values of every input column and [] or None for every output column
+        self.inputs = inputs
+        self.outputs = outputs
+        self.cycles = cycles
+        # values every output column should get, None when they are not checked
+        self.expected = expected
+
+    def source(self):
+        lines = []
+        for node_id in sorted(self.programs):
+            lines.append('@%d' % node_id)
+            lines.extend(self.programs[node_id])
+            lines.append('')
+        return lines
+
+    def fixture(self):
+        return Fixture([TestSet(self.inputs, self.outputs, self.expected)])
+
+    def make_vm(self, codegen=False):
+        vm = VM(codegen=codegen)
+        vm.input_values = [values[:] if values is not None else None for values in self.inputs]
+        vm.output_values = list(self.outputs)
+        if self.expected is not None:
+            vm.expected_values = list(self.expected)
+        vm.split_lines(self.source())
+        vm.build()
+        vm.create_nodes()
+        return vm
+
+    def write(self, base):
+        '''Writes base.tis and the base.json fixture VM.load picks up'''
+        f = open(base + '.tis', 'w')
+        f.write('\n'.join(self.source()) + '\n')
+        f.close()
+        write_json(self.fixture(), base + '.json')
+
+    def copy(self):
+        return FuzzCase(dict((node_id, lines[:]) for node_id, lines in self.programs.iteritems()),
+                        [values[:] if values is not None else None for values in self.inputs],
+                        list(self.outputs), self.cycles,
+                        list(self.expected) if self.expected is not None else None)
+
+
+def random_value(rand):
+    # the bounds often, to get the clamping right
+    if rand.random() < 0.2:
+        return rand.choice([INT_MAX, INT_MIN, INT_MAX - 1, INT_MIN + 1])
+    return rand.randint(-40, 40)
+
+def random_source(rand):
+    if rand.random() < 0.4:
+        return str(random_value(rand))
+    return rand.choice(SOURCES)
+
+def random_program(rand):
+    '''Source lines of one node, its jumps only go to its own labels'''
+    size = rand.randint(1, NODE_MAX_INSTR)
+    labels = ['L%d' % i for i in range(rand.randint(0, min(3, size)))]
+    lines = []
+    for i in range(size):
+        op = rand.choice(['MOV'] * 4 + ['ADD', 'SUB', 'NEG', 'SAV', 'SWP', 'NOP', 'JRO'] + JUMPS)
+        if op == 'MOV':
+            line = 'MOV %s, %s' % (random_source(rand), rand.choice(DESTINATIONS))
+        elif op in ('ADD', 'SUB'):
+            line = '%s %s' % (op, random_source(rand))
+        elif op == 'JRO':
+            line = 'JRO %s' % (rand.choice(SOURCES) if rand.random() < 0.5 else rand.randint(-4, 4))
+        elif op in JUMPS:
+            line = '%s %s' % (op, rand.choice(labels)) if len(labels) > 0 else 'NOP'
+        else:
+            line = op
+        lines.append(line)
+    if rand.random() < 0.02:
+        lines[rand.randrange(size)] = 'HCF'
+    # the labels take the place of instructions, the block stays within its line limit,
+    # each on a line of its own so none replaces another
+    for label, index in zip(labels, rand.sample(range(size), len(labels))):
+        if rand.random() < 0.5:
+            lines[index] = '%s: %s' % (label, lines[index])
+        else:
+            lines[index] = '%s:' % label
+    return lines
+
+def random_case(seed, cycles=FUZZ_CYCLES):
+    rand = random.Random(seed)
+    programs = {}
+    for node_id in rand.sample(range(WIDTH * HEIGHT), rand.randint(1, WIDTH * HEIGHT)):
+        programs[node_id] = random_program(rand)
+    inputs = [None] * WIDTH
+    outputs = [None] * WIDTH
+    for column in rand.sample(range(WIDTH), rand.randint(1, 2)):
+        inputs[column] = [random_value(rand) for i in range(rand.randint(0, 30))]
+    outputs[rand.randrange(WIDTH)] = []
+    return FuzzCase(programs, inputs, outputs, cycles)
+
+def checked_case(seed, cycles):
+    '''A pipeline down one column with repeating inputs and one wrong expected value.
+
+    The expected values are the outputs of the reference run with a value
+    in the middle changed, so the run has to stop there even when the
+    periods around it are fast-forwarded.
+    '''
+    rand = random.Random(seed)
+    column = rand.randrange(WIDTH)
+    programs = {}
+    for row in range(HEIGHT):
+        lines = ['MOV UP, ACC']
+        for i in range(rand.randint(0, 3)):
+            op = rand.choice(['ADD', 'SUB', 'NEG', 'NOP'])
+            lines.append('%s %d' % (op, rand.randint(-40, 40)) if op in ('ADD', 'SUB') else op)
+        programs[row * WIDTH + column] = lines + ['MOV ACC, DOWN']
+    inputs = [None] * WIDTH
+    outputs = [None] * WIDTH
+    period = [random_value(rand) for i in range(rand.randint(1, CHECKED_PERIOD))]
+    inputs[column] = period * (CHECKED_VALUES // len(period))
+    outputs[column] = []
+    case = FuzzCase(programs, inputs, outputs, cycles)
+    vm = case.make_vm()
+    vm.run(REFERENCE[0], cycles)
+    expected = [None] * WIDTH
+    expected[column] = list(vm.output_nodes[0].values)
+    expected[column][len(expected[column]) // 2] += 1
+    case.expected = expected
+    return case
+
+
+def engines():
+    '''Every scheduler, with closures and with generated node programs'''
+    return [(name, codegen) for name in sorted(SCHEDULERS) for codegen in (False, True)]
+
+def snapshot(vm):
+    '''Registers, IPs, ports and outputs of every node'''
+    return (tuple((node.id, node.cycle_count, node.state_key())
+                  for node in vm.input_nodes + vm.nodes + vm.output_nodes),
+            tuple(node.ip for node in vm.input_nodes),
+            tuple((len(node.values), node.values[-1] if len(node.values) > 0 else None)
+                  for node in vm.output_nodes))
+
+def batch_snapshot(bvm, vm):
+    '''The same registers of a BatchVM row as a VM would show them'''
+    return tuple((node.id, int(bvm.acc[0, n]), int(bvm.bak[0, n]), int(bvm.ip[0, n]),
+                  bool(bvm.blocked[0, n]), int(bvm.state[0, n]))
+                 for n, node in enumerate(vm.nodes) if len(node.instr) > 0)
+
+def vm_registers(vm):
+    return tuple((node.id, node.regs[REG_ACC], node.regs[REG_BAK], node.ip, node.blocked, node.state)
+                 for node in vm.nodes if len(node.instr) > 0)
+
+class Engine(object):
+    '''One engine stepping a case a cycle at a time'''
+
+    def __init__(self, case, name, codegen):
+        self.name = '%s%s' % (name, '+codegen' if codegen else '')
+        self.vm = case.make_vm(codegen)
+        self.scheduler = self.vm.make_scheduler(name)
+        self.scheduler.start()
+
+    def step(self):
+        scheduler = self.scheduler
+        # keeps the macro scheduler from jumping past the cycle
+        scheduler.max_cycles = scheduler.cycle + 1
+        status = scheduler.step()
+        scheduler.sync()
+        stuck = scheduler.stalled() if status is None else None
+        return status, stuck is not None, snapshot(self.vm)
+
+
+def compare(case):
+    '''Returns the cycles compared and the first difference between the engines.
+
+    The difference is None when every engine agrees.
+    '''
+    try:
+        reference = Engine(case, *REFERENCE)
+    except Exception as e:
+        # the generator only writes valid programs, one that does not build is a bug too
+        return 0, {'cycle': None, 'engine': 'build', 'expected': None,
+                   'got': "%s: %s" % (type(e).__name__, e)}
+    others = []
+    for name, codegen in engines():
+        if (name, codegen) != REFERENCE:
+            try:
+                others.append(Engine(case, name, codegen))
+            except Exception as e:
+                return 0, {'cycle': 0, 'engine': '%s%s' % (name, '+codegen' if codegen else ''),
+                           'expected': None, 'got': "%s: %s" % (type(e).__name__, e)}
+    batch = None
+    try:
+        batch = BatchVM(case.make_vm(), [case.inputs])
+    except BatchError:
+        pass
+
+    cycle = 0
+    for cycle in range(1, case.cycles + 1):
+        expected = outcome(reference.step)
+        for engine in others:
+            got = outcome(engine.step)
+            if got != expected:
+                return cycle, {'cycle': cycle, 'engine': engine.name, 'expected': expected,
+                               'got': got}
+        if batch is not None:
+            batch.step()
+            got = batch_snapshot(batch, batch.vm)
+            want = vm_registers(reference.vm)
+            if got != want:
+                return cycle, {'cycle': cycle, 'engine': 'batch', 'expected': want, 'got': got}
+        if expected[0] is not None or expected[1]:
+            break
+    return cycle, free_run_divergence(case)
+
+def outcome(step):
+    try:
+        return step()
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+
+def free_run_divergence(case):
+    '''Runs every engine without stopping on each cycle, the way VM.run does.
+
+    Catches what only shows up when the macro blocks and fast-forwarding
+    are left to skip cycles.
+    '''
+    runs = [(REFERENCE + (False,))] + [engine + (False,) for engine in engines() if engine != REFERENCE]
+    runs.append(('lockstep', False, True))
+    expected = None
+    for name, codegen, fast_forward in runs:
+        try:
+            vm = case.make_vm(codegen)
+            result = vm.run(name, case.cycles, fast_forward=fast_forward)
+            got = (result, snapshot(vm))
+        except Exception as e:
+            got = "%s: %s" % (type(e).__name__, e)
+        if expected is None:
+            expected = got
+        elif got != expected:
+            return {'cycle': None, 'engine': '%s%s%s run' % (name, '+codegen' if codegen else '',
+                                                             '+fast-forward' if fast_forward else ''),
+                    'expected': expected, 'got': got}
+    return None
+
+def checked_divergence(case):
+    '''Runs every engine with fast-forwarding against the expected outputs of a checked case.
+
+    Every run must stop on the wrong expected value at the same cycle as
+    the reference run without fast-forwarding.
+    '''
+    runs = [REFERENCE + (False,)] + [engine + (True,) for engine in engines()]
+    expected = None
+    for name, codegen, fast_forward in runs:
+        try:
+            vm = case.make_vm(codegen)
+            result = vm.run(name, case.cycles, fast_forward=fast_forward)
+            got = (result, snapshot(vm))
+        except Exception as e:
+            got = "%s: %s" % (type(e).__name__, e)
+        if expected is None:
+            expected = got
+        elif got != expected:
+            return {'cycle': None, 'engine': '%s%s%s checked run' % (
+                        name, '+codegen' if codegen else '', '+fast-forward' if fast_forward else ''),
+                    'expected': expected, 'got': got}
+    return None
+
+
+def shrink(case, found=None):
+    '''Greedily removes nodes, lines and input values while the engines still diverge'''
+    checks = [0]
+    build = found is not None and found['engine'] == 'build'
+
+    def diverges(candidate):
+        checks[0] += 1
+        found = compare(candidate)[1]
+        # a cut that breaks the build does not reproduce a divergence of the engines
+        return found is not None and (found['engine'] == 'build') == build
+
+    if found is not None and found['cycle'] is not None:
+        smaller = case.copy()
+        smaller.cycles = found['cycle']
+        if diverges(smaller):
+            case = smaller
+    progress = True
+    while progress and checks[0] < MAX_SHRINK_CHECKS:
+        progress = False
+        for candidate in reductions(case):
+            if checks[0] >= MAX_SHRINK_CHECKS:
+                break
+            if diverges(candidate):
+                case = candidate
+                progress = True
+                break
+    return case
+
+def reductions(case):
+    '''Smaller variants of case, the biggest cuts first'''
+    for node_id in sorted(case.programs):
+        smaller = case.copy()
+        del smaller.programs[node_id]
+        yield smaller
+    for node_id in sorted(case.programs):
+        for index in range(len(case.programs[node_id])):
+            smaller = case.copy()
+            del smaller.programs[node_id][index]
+            yield smaller
+    for column, values in enumerate(case.inputs):
+        if values is None:
+            continue
+        if len(values) > 1:
+            smaller = case.copy()
+            smaller.inputs[column] = values[:len(values) // 2]
+            yield smaller
+        for index in range(len(values)):
+            smaller = case.copy()
+            del smaller.inputs[column][index]
+            yield smaller
+        for index, value in enumerate(values):
+            if value != 0:
+                smaller = case.copy()
+                smaller.inputs[column][index] = 0
+                yield smaller
+
+
+def fuzz_seed(seed, cycles=FUZZ_CYCLES):
+    '''Runs the case of one seed, returns its cycles and the shrunk case of a divergence'''
+    case = random_case(seed, cycles)
+    ran, found = compare(case)
+    if found is None:
+        checked = checked_case(seed, cycles * CHECKED_CYCLES)
+        found = checked_divergence(checked)
+        if found is not None:
+            return {'seed': seed, 'cycles': ran, 'divergence': found, 'case': checked}
+        return {'seed': seed, 'cycles': ran, 'divergence': None}
+    small = shrink(case, found)
+    return {'seed': seed, 'cycles': ran, 'divergence': compare(small)[1] or found, 'case': small}
+
+def fuzz(cases, seed=None, workers=None, cycles=FUZZ_CYCLES, out_dir=None):
+    '''Fuzzes cases seeds from seed on, writes every shrunk reproducer to out_dir'''
+    if seed is None:
+        seed = random.randrange(1 << 30)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    start = time.time()
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_fuzz_seed, [(s, cycles) for s in range(seed, seed + cases)], chunksize=8)
+    finally:
+        pool.terminate()
+        pool.join()
+    failures = [result for result in results if result['divergence'] is not None]
+    if out_dir is not None and len(failures) > 0:
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        for failure in failures:
+            failure['case'].write(os.path.join(out_dir, 'fuzz_%d' % failure['seed']))
+    return {'seed': seed, 'cases': cases, 'cycles': sum(result['cycles'] for result in results),
+            'seconds': round(time.time() - start, 3), 'failures': failures}
+
+def _fuzz_seed(args):
+    return fuzz_seed(*args)
+
+def describe(found):
+    '''One line on where an engine left the reference'''
+    if found['engine'] == 'build':
+        return 'case does not build: %s' % found['got']
+    where = 'cycle %d' % found['cycle'] if found['cycle'] is not None else 'end of run'
+    expected, got = found['expected'], found['got']
+    if isinstance(expected, tuple) and isinstance(got, tuple):
+        # narrows the snapshots down to the first part that differs
+        while isinstance(expected, tuple) and isinstance(got, tuple) and len(expected) == len(got):
+            parts = [(a, b) for a, b in zip(expected, got) if a != b]
+            if len(parts) < 1:
+                break
+            expected, got = parts[0]
+            if not isinstance(expected, tuple) or len(expected) < 1 or isinstance(expected[0], tuple):
+                continue
+            break
+    return '%s differs at %s: expected %r, got %r' % (found['engine'], where, expected, got)
@@ -0,0 +1,49 @@
+from array import array
+from Enums import *
+
+NO_NEIGHBOR = -1
+
+class GridError(Exception):
+    pass
+
+
+class Grid(object):
+    '''Size of the node grid and the neighbors of every position.
+
+    Positions count row by row from the top left corner, like the node
+    ids. neighbors is one flat array with a slot per position and port,
+    holding the position on the other side or NO_NEIGHBOR at the edge.
+    '''
+
+    def __init__(self, width=WIDTH, height=HEIGHT):
+        if width < 1 or height < 1:
+            raise GridError("Invalid grid size %dx%d" % (width, height))
+        self.width = width
+        self.height = height
+        self.size = width * height
+        ports = len(PORTS_LIST)
+        self.neighbors = array('i', [NO_NEIGHBOR]) * (self.size * ports)
+        neighbors = self.neighbors
+        for index in range(self.size):
+            row, col = divmod(index, width)
+            base = index * ports
+            if col > 0:
+                neighbors[base + PORT_LEFT] = index - 1
+            if col < width - 1:
+                neighbors[base + PORT_RIGHT] = index + 1
+            if row > 0:
+                neighbors[base + PORT_UP] = index - width
+            if row < height - 1:
+                neighbors[base + PORT_DOWN] = index + width
+
+    def __repr__(self):
+        return "Grid %dx%d" % (self.width, self.height)
+
+    def index(self, row, col):
+        return row * self.width + col
+
+    def neighbor(self, index, direction):
+        return self.neighbors[index * len(PORTS_LIST) + direction]
+
+    def bottom(self, col):
+        return self.index(self.height - 1, col)
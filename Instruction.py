@@ -1,6 +1,7 @@
 from Enums import *
 
 class Instruction(object):
+    __slots__ = ('type', 'value', 'src', 'dest', 'src_type', 'target', 'line_num')
 
     def __init__(self, _type, _src=None, _dest=None):
         self.type = _type
@@ -8,26 +9,55 @@ class Instruction(object):
         self.src = _src
         self.dest = _dest
         self.src_type = SRC_TYPE_NONE
-        self.line_num = 0 # TODO
+        self.target = None # absolute jump address, set by the linker
+        self.line_num = 0 # line in the node source block
 
         if self.type == INSTR_LABEL:
             self.value = _src
             self.src = None
-        elif self.type in REGISTERS_SET:
+        elif self.type not in INSTRUCTIONS_SET:
             raise Exception()
 
-        if self.src in REGISTERS_SET:
-           self.src_type = SRC_TYPE_REG
+        # registers are given by name and stored as their code
+        if self.src in REGISTER_CODES:
+            self.src = REGISTER_CODES[self.src]
+            self.src_type = SRC_TYPE_REG
         elif type(self.src) is int:
-           self.src_type = SRC_TYPE_INT
+            self.src_type = SRC_TYPE_INT
+        elif self.src is not None:
+            self.src_type = SRC_TYPE_LABEL
+        if self.dest in REGISTER_CODES:
+            self.dest = REGISTER_CODES[self.dest]
+
+    def to_tuple(self):
+        return (self.type, self.value, self.src, self.dest, self.src_type, self.target, self.line_num)
+
+    @classmethod
+    def from_tuple(cls, fields):
+        # skips the name lookups of __init__, the fields are already decoded
+        instr = cls.__new__(cls)
+        (instr.type, instr.value, instr.src, instr.dest, instr.src_type,
+         instr.target, instr.line_num) = fields
+        return instr
+
+    def src_name(self):
+        if self.src_type == SRC_TYPE_REG:
+            return REGISTER_NAMES[self.src]
+        return self.src
+
+    def dest_name(self):
+        if self.dest is not None:
+            return REGISTER_NAMES[self.dest]
+        return None
 
     def __repr__(self):
+        name = INSTRUCTION_NAMES[self.type]
         if self.dest is not None and self.src is not None:
-            return "%s <%s> <%s>" % (self.type, self.src, self.dest)
+            return "%s <%s> <%s>" % (name, self.src_name(), self.dest_name())
         if self.src is not None:
-            return "%s <%s>" % (self.type, self.src)
+            return "%s <%s>" % (name, self.src_name())
         else:
             if self.value is not None:
-                return '%s "%s"' % (self.type, self.value)
+                return '%s "%s"' % (name, self.value)
             else:
-                return "%s" % self.type
+                return "%s" % name
@@ -44,9 +44,12 @@ KW_LAST  = 'LAST'
 lang_registers = [KW_ACC, KW_BAK, KW_NIL, KW_LEFT, KW_RIGHT, KW_UP, KW_DOWN, KW_ANY, KW_LAST]
 
 class Token(object):
-    def __init__(self, type, value):
+    __slots__ = ('type', 'value', 'line')
+
+    def __init__(self, type, value, line=None):
         self.type = type
         self.value = value
+        self.line = line
 
     def __repr__(self):
         value = self.value
@@ -55,13 +58,15 @@ class Token(object):
         return "Token(%s, %s)" % (self.type, value)
 
 class Tokenizer(object):
+    # master regex of every tokenizer class, compiled on first use
+    _master_regex = {}
+
     def __init__(self):
         self.defs = OrderedDict()
         self.option = {}
         self.option['lineno'] = True
         self.option['uppercase'] = False
         self.option['oneline_comment_start'] = '//'
-        self.lines_number = []
         self.line_pos = 0
 
     def init(self):
@@ -71,61 +76,51 @@ class Tokenizer(object):
         pass
 
     def define_token(self, name, pattern):
+        # the pattern must not have capturing groups, the token type is the matched group name
         self.defs[name] = pattern
 
     def define_token_list(self, name, array):
-        self.defs[name] = '^' + '(?=\s|\Z)|^'.join(array) + '(?=\s|\Z)'
+        # whole words only, a word matching a longer pattern is still a keyword
+        self.defs[name] = '(?:' + '|'.join(array) + ')(?![a-zA-Z0-9_])'
 
     def define_simple_token_list(self, name, array):
         self.defs[name] = '|'.join(array)
 
+    def master_regex(self):
+        regex = Tokenizer._master_regex.get(type(self))
+        if regex is None:
+            comment_id = re.escape(self.option['oneline_comment_start'])
+            groups = ['(?P<_COMMENT>%s[^\r\n]*)' % comment_id]
+            groups += ['(?P<%s>%s)' % (name, pattern) for name, pattern in self.defs.iteritems()]
+            groups.append('(?P<_NEWLINE>\r\n?|\n)')
+            regex = Tokenizer._master_regex[type(self)] = re.compile('|'.join(groups))
+        return regex
+
     def make_token(self, word):
-        for token_type, token_value in self.defs.iteritems():
-            if re.match(token_value, word) is not None:
-                return Token(token_type, word)
+        match = self.master_regex().match(word)
+        if match is not None and not match.lastgroup.startswith('_'):
+            return Token(match.lastgroup, word)
         return None
 
     def tokenize(self, sourcecode):
-        lines = self._remove_comments(sourcecode).splitlines()
-        patterns = ""
-        for k, v in self.defs.iteritems():
-            patterns += v + '|'
-        if len(patterns) > 0:
-            patterns = patterns[:-1]
-        word = re.compile(patterns)
-
-        lines_count = 0
         tokens = []
-        for line in lines:
-            lines_count += 1
-            line_tokens = word.findall(line)
-            if len(line_tokens) > 0:
-                tokens.extend(self._line_to_tokens(line_tokens, lines_count))
-                for i in range(len(line_tokens)):
-                    self.lines_number.append(lines_count)
+        line = 1
+        # characters matching no token are skipped
+        for match in self.master_regex().finditer(sourcecode):
+            token_type = match.lastgroup
+            if token_type == '_NEWLINE':
+                line += 1
+            elif token_type != '_COMMENT':
+                tokens.append(Token(token_type, match.group(), line))
         return tokens
 
-    def _line_to_tokens(self, raw_tokens, lines_count):
-        tokens = []
-        for el in raw_tokens:
-            token = self.make_token(el)
-            if token is not None:
-                tokens.append(token)
-            else:
-                raise Exception("Unknown token at line %d" % lines_count)
-        return tokens
-
-    def _remove_comments(self, sourcecode):
-        comment_id = self.option['oneline_comment_start']
-        return re.sub(comment_id + r'.*?$', '', sourcecode, 0, re.MULTILINE)
-
 
 
 class Lexer(Tokenizer):
     def __init__(self):
         super(Lexer, self).__init__()
         self._tokens = []
-        self._index = -1 # tokens & lines index
+        self._index = -1 # tokens index
 
     def lex(self, _input, _type='sourcecode'):
         if _type == "file":
@@ -134,8 +129,6 @@ class Lexer(Tokenizer):
             f.close()
         else:
             self._tokens = self.tokenize(_input)
-        if len(self._tokens) > 0:
-            print "tokens:", self._tokens
 
 
     def has_more_tokens(self):
@@ -144,7 +137,7 @@ class Lexer(Tokenizer):
     def advance(self):
         self._index += 1
         self.current_token = self._tokens[self._index]
-        self.line_pos = self.lines_number[self._index]
+        self.line_pos = self.current_token.line
 
     def peek_next_token(self):
         if self.has_more_tokens():
@@ -0,0 +1,40 @@
+from Enums import *
+
+JUMP_INSTRUCTIONS = [INSTR_JMP, INSTR_JEZ, INSTR_JNZ, INSTR_JGZ, INSTR_JLZ]
+
+class LinkerError(Exception):
+    def __init__(self, message, node_id=None, line_pos=-1):
+        error = message
+        if line_pos >= 0:
+            error += " at line %d" % line_pos
+        if node_id is not None:
+            error += " of node @%d" % node_id
+        self.args = [error]
+
+class Linker(object):
+    '''Rewrites jump operands to absolute instruction indexes'''
+
+    def __init__(self, symbol_table, node_id=None, first_line=1):
+        self.symbol_table = symbol_table
+        self.node_id = node_id
+        # file line of the first line of the node block, line_num counts from 1 in it
+        self.first_line = first_line
+
+    def link(self, instructions):
+        size = min(len(instructions), NODE_MAX_INSTR)
+        for index, instr in enumerate(instructions):
+            if instr.type in JUMP_INSTRUCTIONS:
+                addr = self.symbol_table.get(instr.src)
+                if addr is None:
+                    raise LinkerError("Undefined label '%s'" % instr.src, self.node_id,
+                                      self.first_line + instr.line_num - 1)
+                # a label past the last instruction wraps around like fetch_next
+                if addr > size - 1:
+                    addr = 0
+                instr.target = addr
+            elif instr.type == INSTR_JRO and instr.src_type == SRC_TYPE_INT:
+                instr.target = self.jump_offset(index, instr.src, size)
+
+    @staticmethod
+    def jump_offset(index, offset, size):
+        return max(0, min(index + offset, size - 1))
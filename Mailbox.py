@@ -0,0 +1,79 @@
+from Enums import *
+
+class Mailbox(object):
+    '''One direction of the link between two neighbors.
+
+    The writer offers a value and blocks, the reader waits on the box and
+    blocks. Once both happened the box is ready and the next resolve of its
+    Switchboard accepts the value: it lands in the port register of the
+    reader and both ends are woken. A box with a missing end never gets
+    ready, so its node stays blocked.
+    '''
+
+    __slots__ = ('writer', 'reader', 'direction', 'port', 'value', 'waiting', 'switchboard')
+
+    def __init__(self, writer, reader, direction, switchboard=None):
+        self.writer = writer
+        self.reader = reader
+        # port of the writer, the reader gets the value on the opposite one
+        self.direction = direction
+        if direction in PORTS_LIST:
+            self.port = OPPOSITE_PORT[direction]
+        else:
+            # ANY and LAST only get boxes nothing ever writes to
+            self.port = direction
+        self.value = None
+        self.waiting = False
+        self.switchboard = switchboard
+
+    def __repr__(self):
+        return "Mailbox %s %s %s" % (REGISTER_NAMES[self.direction], self.value, self.waiting)
+
+    def reset(self):
+        self.value = None
+        self.waiting = False
+
+    def offer(self, value):
+        self.value = value
+        if self.waiting:
+            self.switchboard.ready.append(self)
+
+    def wait(self):
+        self.waiting = True
+        if self.value is not None:
+            self.switchboard.ready.append(self)
+
+    def accept(self):
+        value = self.value
+        self.value = None
+        self.waiting = False
+        writer = self.writer
+        writer.blocked = False
+        writer.state = NODE_STATE_IDLE
+        writer.fetch_next()
+        reader = self.reader
+        reader.regs[self.port] = value
+        reader.blocked = False
+        reader.state = NODE_STATE_IDLE
+
+
+class Switchboard(object):
+    '''The mailboxes of a grid that are ready for a transfer'''
+
+    def __init__(self):
+        self.ready = []
+
+    def connect(self, writer, reader, direction):
+        box = Mailbox(writer, reader, direction, self)
+        writer.outbox[direction] = box
+        reader.inbox[box.port] = box
+
+    def resolve(self):
+        '''Runs the pending transfers, returns their mailboxes'''
+        ready = self.ready
+        if len(ready) < 1:
+            return ready
+        self.ready = []
+        for box in ready:
+            box.accept()
+        return ready
@@ -1,20 +1,26 @@
 from Parser import Parser
+from Instruction import Instruction
+from Linker import Linker, LinkerError
+from Codegen import generate_program
+from Mailbox import Mailbox
 from SymbolTable import SymbolTable
 from Utils import clamp
 from Enums import *
 
-class IONode(object):
-    def __init__(self):
-        pass
-
 class ParserNode(object):
+    __slots__ = ('source_code', 'source_line', 'symtable', 'instr', 'parser')
+
     def __init__(self):
         self.source_code = []
+        self.source_line = 0 # file line of the first source line
         self.symtable = SymbolTable()
         self.instr = []
-        self.parser = Parser(self.symtable, self.instr)
+        # created on first parse, nodes loaded from an image never need one
+        self.parser = None
 
     def parse(self, code_lines=None):
+        if self.parser is None:
+            self.parser = Parser(self.symtable, self.instr, self.source_line)
         if code_lines is None:
             code_lines = self.source_code
         code = '\n'.join(code_lines)
@@ -23,24 +29,44 @@ class ParserNode(object):
     def add_source_line(self, line):
         self.source_code.append(line)
 
+    def file_line(self, instr):
+        '''Line of the source file instr comes from, line_num counts in the block'''
+        return self.source_line + instr.line_num - 1
+
 
 class BasicNode(ParserNode):
+    __slots__ = ('id', 'ip', 'halted', 'blocked', 'state', 'outbox', 'inbox', 'cycle_count')
+
     def __init__(self, _id=None):
         super(BasicNode, self).__init__()
         self.id = _id
         self.ip = 0
         self.halted = False
 
-        self.ports = []
-        self.read_locked = False # can the neighbor node read from this node ? set to false after each cycle ending
-        self.neighbors = {}
         self.blocked = False
         self.state = NODE_STATE_IDLE
 
-        self.deadlock = False
+        # mailboxes by port, connect swaps in the ones shared with a neighbor
+        self.outbox = [Mailbox(self, None, direction) for direction in PORTS_LIST]
+        self.inbox = [None] * REGISTERS_COUNT
+        for port in PORT_REGISTERS:
+            self.inbox[port] = Mailbox(None, self, OPPOSITE_PORT[port] if port in PORTS_LIST else port)
 
         self.cycle_count = 0
 
+    def reset(self):
+        '''Rewinds the node for another run, its program and links stay'''
+        self.ip = 0
+        self.halted = False
+        self.blocked = False
+        self.state = NODE_STATE_IDLE
+        self.cycle_count = 0
+        for box in self.outbox:
+            box.reset()
+        for box in self.inbox:
+            if box is not None:
+                box.reset()
+
     def fetch(self):
         if len(self.instr) > 0:
             return self.instr[self.ip]
@@ -54,26 +80,51 @@ class BasicNode(ParserNode):
     @staticmethod
     def opposite_dir(dir):
         assert dir in PORTS_LIST
-        if   dir == PORT_LEFT:  return PORT_RIGHT
-        elif dir == PORT_RIGHT: return PORT_LEFT
-        elif dir == PORT_UP:    return PORT_DOWN
-        elif dir == PORT_DOWN:  return PORT_UP
+        return OPPOSITE_PORT[dir]
 
-    def connect(self, other, direction):
-        self.neighbors[direction] = other
-        other.neighbors[self.opposite_dir(direction)] = self
+    def connect(self, other, direction, switchboard):
+        switchboard.connect(self, other, direction)
+        switchboard.connect(other, self, self.opposite_dir(direction))
 
 
 class BasicExecutionNode(BasicNode):
+    __slots__ = ('regs', 'program', 'local')
+
     def __init__(self, _id=None):
         super(BasicExecutionNode, self).__init__(_id)
-        self.regs = { REG_ACC: 0, REG_BAK: 0, REG_NIL: 0,
-                      REG_LEFT: None, REG_RIGHT: None, REG_UP: None, REG_DOWN: None,
-                      REG_ANY: None, REG_LAST: None }
+        # register file indexed by register code, port slots hold None when empty
+        self.regs = [None] * REGISTERS_COUNT
+        self.regs[REG_ACC] = 0
+        self.regs[REG_BAK] = 0
+        self.regs[REG_NIL] = 0
+        self.program = []
+        # per ip, True when the instruction only changes this node
+        self.local = []
 
     def __repr__(self):
         return "ExecutionNode %i %s\n" % (self.id, self.instr)
 
+    def reset(self):
+        super(BasicExecutionNode, self).reset()
+        # in place, the compiled program holds on to this list
+        regs = self.regs
+        for code in range(REGISTERS_COUNT):
+            regs[code] = None
+        regs[REG_ACC] = 0
+        regs[REG_BAK] = 0
+        regs[REG_NIL] = 0
+
+    def state_name(self):
+        return NODE_STATE_NAMES[self.state]
+
+    def regs_view(self):
+        return dict((REGISTER_NAMES[code], value) for code, value in enumerate(self.regs))
+
+    def state_key(self):
+        '''Everything the next cycles depend on, cycle_count left out'''
+        return (self.ip, self.state, self.blocked, self.halted, tuple(self.regs),
+                tuple(box.value for box in self.outbox))
+
     def run(self):
         if len(self.instr) < 1:
             return
@@ -84,6 +135,9 @@ class BasicExecutionNode(BasicNode):
         new_instr = []
         for index, instr in enumerate(self.instr):
             if instr.type == INSTR_LABEL:
+                if self.symtable.has(instr.value):
+                    raise LinkerError("Duplicate label '%s'" % instr.value, self.id,
+                                      self.file_line(instr))
                 addr = len(new_instr)
                 self.symtable.add(instr.value, addr)
             else:
@@ -98,6 +152,18 @@ class BasicExecutionNode(BasicNode):
 
         self.instr = new_instr[:]
 
+    def link(self):
+        Linker(self.symtable, self.id, self.source_line).link(self.instr)
+
+    def image(self):
+        '''Linked program as plain values, see load_image'''
+        return (tuple(instr.to_tuple() for instr in self.instr), self.symtable.table)
+
+    def load_image(self, image):
+        instructions, symbols = image
+        self.instr = [Instruction.from_tuple(fields) for fields in instructions]
+        self.symtable.table = dict(symbols)
+
     def fetch_next(self):
         self.ip += 1
         if self.ip > NODE_MAX_INSTR - 1 or self.ip > len(self.instr) - 1:
@@ -110,189 +176,309 @@ class BasicExecutionNode(BasicNode):
         self.blocked = True
         self.state = NODE_STATE_READ
         if self.regs[src] is not None:
+            # accepted from the mailbox at the start of this cycle
             value = self.regs[src]
             self.regs[src] = None
+        else:
+            self.inbox[src].wait()
         return value
 
     def write(self, dest, value):
-        assert dest in PORT_REGISTERS
+        assert dest in PORTS_LIST
         self.blocked = True
         self.state = NODE_STATE_WRITE
-        self.regs[dest] = value
-
-    def before_cycle(self):
-        instr = self.fetch()
-        if self.deadlock and self.state == NODE_STATE_READ:
-            #print self.id, "deadlock", self.state
-            direction = instr.src
-            neighbor = self.neighbors[direction]
-            value = neighbor.read_port(direction)
-            if value is not None:
-                self.regs[direction] = value
-                self.blocked = False
-                self.deadlock = False
-                self.state = NODE_STATE_IDLE
-            else:
-                return
-
-    def after_cycle(self):
-        if self.blocked:
-            self.deadlock = True
-
-    def read_port(self, direction):
-        value = None
-        opp_dir = self.opposite_dir(direction)
-        if self.regs[opp_dir] is not None and self.blocked is True:
-            value = self.regs[opp_dir]
-            self.regs[opp_dir] = None
-            if value is not None:
-                self.blocked = False
-                self.deadlock = False
-                self.state = NODE_STATE_IDLE
-                self.fetch_next()
-        return value
+        self.outbox[dest].offer(value)
 
-    def cycle(self):
-        self.cycle_count += 1
-
-        if len(self.instr) < 1:
+    def compile(self, codegen=False):
+        self.local = [self.is_local(instr) for instr in self.instr]
+        if codegen:
+            self.program = generate_program(self)
             return
+        self.program = []
+        for index, instr in enumerate(self.instr):
+            self.program.append(self._compile_instr(index, instr))
 
-        instr = self.fetch()
-
-        if self.blocked:
-            return
-        #print '[', self.id, ']', self.ip, self.state, ':', instr, self.regs
+    @staticmethod
+    def is_local(instr):
+        '''True when running instr can't be seen by a neighbor or stop the VM'''
+        if instr.type in (INSTR_NOP, INSTR_SWP, INSTR_SAV, INSTR_NEG, INSTR_JMP,
+                          INSTR_JEZ, INSTR_JNZ, INSTR_JGZ, INSTR_JLZ):
+            return True
+        if instr.type not in (INSTR_MOV, INSTR_ADD, INSTR_SUB, INSTR_JRO):
+            return False
+        if instr.src_type == SRC_TYPE_REG and instr.src not in LOCAL_REGISTERS:
+            return False
+        return instr.type != INSTR_MOV or instr.dest in LOCAL_REGISTERS
+
+    def _compile_instr(self, index, instr):
+        compiler = self.COMPILERS.get(instr.type)
+        if compiler is None:
+            raise Exception('Unknown opcode %s' % instr.type)
+        next_ip = index + 1
+        if next_ip > NODE_MAX_INSTR - 1 or next_ip > len(self.instr) - 1:
+            next_ip = 0
+        return compiler(self, instr, next_ip)
+
+    def _compile_mov(self, instr, next_ip):
+        regs = self.regs
+        src = instr.src
+        dest = instr.dest
+
+        if instr.src_type == SRC_TYPE_INT:
+            value = int(src)
+            if dest in PORTS_LIST:
+                def op():
+                    self.write(dest, value)
+            else:
+                def op():
+                    regs[dest] = value
+                    self.state = NODE_STATE_RUN
+                    self.ip = next_ip
+        elif src in PORT_REGISTERS:
+            if dest in PORTS_LIST:
+                def op():
+                    value = self.read_from(src)
+                    if value is None:
+                        return
+                    self.write(dest, value)
+            else:
+                def op():
+                    value = self.read_from(src)
+                    if value is None:
+                        return
+                    regs[dest] = value
+                    self.blocked = False
+                    self.state = NODE_STATE_RUN
+                    self.ip = next_ip
+        else:
+            if dest in PORTS_LIST:
+                def op():
+                    self.write(dest, regs[src])
+            else:
+                def op():
+                    regs[dest] = regs[src]
+                    self.state = NODE_STATE_RUN
+                    self.ip = next_ip
+        return op
 
-        is_jumping = False
+    def _compile_add(self, instr, next_ip):
+        return self._compile_arith(instr, next_ip, 1)
 
-        # MOV
-        if instr.type == INSTR_MOV:
-            self.blocked = True
-            src = instr.src
-            dest = instr.dest
-            value = None
+    def _compile_sub(self, instr, next_ip):
+        return self._compile_arith(instr, next_ip, -1)
 
-            if instr.src_type == SRC_TYPE_INT:
-                value = int(src)
-            elif src in PORT_REGISTERS:
-                value = self.read_from(src)
-                if value is None:
-                    return
-            else:
-                value = self.regs[dest] = self.regs[src]
+    def _compile_arith(self, instr, next_ip, sign):
+        regs = self.regs
+        src = instr.src
 
-            if dest in PORTS_LIST:
-                self.write(dest, value)
-                return
-            else:
-                self.regs[dest] = value
-
-            self.blocked = False
-        # ADD
-        elif instr.type == INSTR_ADD:
-            src = instr.src
-            if src in PORT_REGISTERS:
-                self.blocked = True
+        if instr.src_type == SRC_TYPE_REG and src in PORT_REGISTERS:
+            def op():
                 value = self.read_from(src)
                 if value is None:
                     return
-                self.regs[REG_ACC] = clamp(self.regs[REG_ACC] + value)
+                regs[REG_ACC] = clamp(regs[REG_ACC] + sign * value)
                 self.blocked = False
-            elif instr.src_type == SRC_TYPE_REG:
-                self.regs[REG_ACC] = clamp(self.regs[REG_ACC] + self.regs[src])
-            elif instr.src_type == SRC_TYPE_INT:
-                self.regs[REG_ACC] = clamp(self.regs[REG_ACC] + int(src))
-            else:
-                raise Exception()
-        # SUB
-        elif instr.type == INSTR_SUB:
-            src = instr.src
-            if src in PORT_REGISTERS:
-                self.blocked = True
+                self.state = NODE_STATE_RUN
+                self.ip = next_ip
+        elif instr.src_type == SRC_TYPE_REG:
+            def op():
+                regs[REG_ACC] = clamp(regs[REG_ACC] + sign * regs[src])
+                self.state = NODE_STATE_RUN
+                self.ip = next_ip
+        elif instr.src_type == SRC_TYPE_INT:
+            value = sign * int(src)
+            def op():
+                regs[REG_ACC] = clamp(regs[REG_ACC] + value)
+                self.state = NODE_STATE_RUN
+                self.ip = next_ip
+        else:
+            raise Exception()
+        return op
+
+    def _compile_neg(self, instr, next_ip):
+        regs = self.regs
+        def op():
+            regs[REG_ACC] = -regs[REG_ACC]
+            self.state = NODE_STATE_RUN
+            self.ip = next_ip
+        return op
+
+    def _compile_sav(self, instr, next_ip):
+        regs = self.regs
+        def op():
+            regs[REG_BAK] = regs[REG_ACC]
+            self.state = NODE_STATE_RUN
+            self.ip = next_ip
+        return op
+
+    def _compile_swp(self, instr, next_ip):
+        regs = self.regs
+        def op():
+            regs[REG_ACC], regs[REG_BAK] = regs[REG_BAK], regs[REG_ACC]
+            self.state = NODE_STATE_RUN
+            self.ip = next_ip
+        return op
+
+    def _compile_jmp(self, instr, next_ip):
+        return self._compile_jump(instr, next_ip, None)
+
+    def _compile_jez(self, instr, next_ip):
+        return self._compile_jump(instr, next_ip, lambda acc: acc == 0)
+
+    def _compile_jnz(self, instr, next_ip):
+        return self._compile_jump(instr, next_ip, lambda acc: acc != 0)
+
+    def _compile_jgz(self, instr, next_ip):
+        return self._compile_jump(instr, next_ip, lambda acc: acc > 0)
+
+    def _compile_jlz(self, instr, next_ip):
+        return self._compile_jump(instr, next_ip, lambda acc: acc < 0)
+
+    def _compile_jump(self, instr, next_ip, condition):
+        regs = self.regs
+        target = instr.target
+
+        if condition is None:
+            def op():
+                self.ip = target
+                self.state = NODE_STATE_RUN
+        else:
+            def op():
+                if condition(regs[REG_ACC]):
+                    self.ip = target
+                else:
+                    self.ip = next_ip
+                self.state = NODE_STATE_RUN
+        return op
+
+    def _compile_jro(self, instr, next_ip):
+        regs = self.regs
+        src = instr.src
+        size = min(len(self.instr), NODE_MAX_INSTR)
+        jump_offset = Linker.jump_offset
+
+        if instr.src_type == SRC_TYPE_INT:
+            target = instr.target
+            def op():
+                self.ip = target
+                self.state = NODE_STATE_RUN
+        elif src in PORT_REGISTERS:
+            def op():
                 value = self.read_from(src)
                 if value is None:
                     return
-                self.regs[REG_ACC] = clamp(self.regs[REG_ACC] - value)
+                self.ip = jump_offset(self.ip, value, size)
                 self.blocked = False
-            elif instr.src_type == SRC_TYPE_REG:
-                self.regs[REG_ACC] = clamp(self.regs[REG_ACC] - self.regs[src])
-            elif instr.src_type == SRC_TYPE_INT:
-                self.regs[REG_ACC] = clamp(self.regs[REG_ACC] - int(src))
-            else:
-                raise Exception()
-        # NEG
-        elif instr.type == INSTR_NEG:
-            self.regs[REG_ACC] = -self.regs[REG_ACC]
-        # SAV
-        elif instr.type == INSTR_SAV:
-            self.regs[REG_BAK] = self.regs[REG_ACC]
-        # SWP
-        elif instr.type == INSTR_SWP:
-            tmp = self.regs[REG_BAK]
-            self.regs[REG_BAK] = self.regs[REG_ACC]
-            self.regs[REG_ACC] = tmp
-        # JMP
-        elif instr.type == INSTR_JMP:
-            addr = self.symtable.get(instr.src)
-            self.ip = int(addr)
-            is_jumping = True
-        # JEZ
-        elif instr.type == INSTR_JEZ:
-            if self.regs[REG_ACC] == 0:
-                addr = self.symtable.get(instr.src)
-                self.ip = int(addr)
-                is_jumping = True
-        # JNZ
-        elif instr.type == INSTR_JNZ:
-            if self.regs[REG_ACC] != 0:
-                addr = self.symtable.get(instr.src)
-                self.ip = int(addr)
-                is_jumping = True
-        # JGZ
-        elif instr.type == INSTR_JGZ:
-            if self.regs[REG_ACC] > 0:
-                addr = self.symtable.get(instr.src)
-                self.ip = int(addr)
-                is_jumping = True
-        # JLZ
-        elif instr.type == INSTR_JLZ:
-            if self.regs[REG_ACC] < 0:
-                addr = self.symtable.get(instr.src)
-                self.ip = int(addr)
-                is_jumping = True
-        # JRO
-        elif instr.type == INSTR_JRO:
-            addr = self.regs[REG_ACC]
-            self.ip = addr
-            is_jumping = True
-        # HALT
-        elif instr.type == INSTR_HCF:
-            # HCF Halt and Catch Fire
-            self.halted = True
-        elif instr.type == INSTR_NOP:
-            pass
+                self.state = NODE_STATE_RUN
+        elif instr.src_type == SRC_TYPE_REG:
+            def op():
+                self.ip = jump_offset(self.ip, regs[src], size)
+                self.state = NODE_STATE_RUN
         else:
-            print 'Unknown opcode',
+            raise Exception()
+        return op
+
+    def _compile_hcf(self, instr, next_ip):
+        # HCF Halt and Catch Fire
+        def op():
+            self.halted = True
+            self.state = NODE_STATE_RUN
+            self.ip = next_ip
+        return op
+
+    def _compile_nop(self, instr, next_ip):
+        def op():
+            self.state = NODE_STATE_RUN
+            self.ip = next_ip
+        return op
 
-        self.state = NODE_STATE_RUN
+    def cycle(self):
+        self.cycle_count += 1
 
-        #print self.regs
+        if self.blocked or len(self.program) < 1:
+            return
 
-        if not is_jumping:
-            self.fetch_next()
+        self.program[self.ip]()
 
 
-class InputNode(BasicExecutionNode):
-    def __init__(self, _id=None):
-        super(InputNode, self).__init__(_id)
-        self.regs = { REG_ACC: 0,
-                      REG_LEFT: None, REG_RIGHT: None, REG_UP: None, REG_DOWN: None }
+BasicExecutionNode.COMPILERS = {
+    INSTR_MOV: BasicExecutionNode._compile_mov,
+    INSTR_ADD: BasicExecutionNode._compile_add,
+    INSTR_SUB: BasicExecutionNode._compile_sub,
+    INSTR_NEG: BasicExecutionNode._compile_neg,
+    INSTR_SAV: BasicExecutionNode._compile_sav,
+    INSTR_SWP: BasicExecutionNode._compile_swp,
+    INSTR_JMP: BasicExecutionNode._compile_jmp,
+    INSTR_JEZ: BasicExecutionNode._compile_jez,
+    INSTR_JNZ: BasicExecutionNode._compile_jnz,
+    INSTR_JGZ: BasicExecutionNode._compile_jgz,
+    INSTR_JLZ: BasicExecutionNode._compile_jlz,
+    INSTR_JRO: BasicExecutionNode._compile_jro,
+    INSTR_HCF: BasicExecutionNode._compile_hcf,
+    INSTR_NOP: BasicExecutionNode._compile_nop,
+}
+
+
+class IONode(object):
+    '''An input or output of the grid, its values behind the mailbox of one port.
+
+    Nothing is parsed or run, the node only has the flags the schedulers
+    look at and the mailbox it exchanges values through.
+    '''
+
+    __slots__ = ('id', 'ip', 'blocked', 'state', 'cycle_count', 'values', 'port', 'outbox', 'inbox')
+
+    def __init__(self, _id, port):
+        self.id = _id
+        self.ip = 0
+        self.blocked = False
+        self.state = NODE_STATE_IDLE
+        self.cycle_count = 0
         self.values = []
+        self.port = port
+        # indexed like the ones of a code node, only the port gets a mailbox
+        self.outbox = [None] * REGISTERS_COUNT
+        self.inbox = [None] * REGISTERS_COUNT
+
+    def reset(self):
+        self.ip = 0
+        self.blocked = False
+        self.state = NODE_STATE_IDLE
+        self.cycle_count = 0
+        for box in self.outbox + self.inbox:
+            if box is not None:
+                box.reset()
+
+    def state_name(self):
+        return NODE_STATE_NAMES[self.state]
+
+    def fetch_next(self):
+        pass
+
+
+class InputNode(IONode):
+    __slots__ = ('end_reached',)
+
+    def __init__(self, _id=None):
+        # sits above the grid
+        super(InputNode, self).__init__(_id, PORT_DOWN)
         self.end_reached = False
+        self.outbox[PORT_DOWN] = Mailbox(self, None, PORT_DOWN)
 
     def __repr__(self):
-        return "InputNode %i %s\n" % (self.id, self.instr)
+        return "InputNode %i %s\n" % (self.id, self.values)
+
+    def reset(self):
+        super(InputNode, self).reset()
+        self.end_reached = False
+
+    def connect(self, other, direction, switchboard):
+        # only ever writes, the neighbor has no mailbox towards it
+        switchboard.connect(self, other, direction)
+
+    def state_key(self):
+        # the position in the values is tracked apart by the loop detector
+        return (self.state, self.blocked, self.end_reached, self.outbox[self.port].value)
 
     def fetch_next(self):
         self.ip += 1
@@ -309,54 +495,36 @@ class InputNode(BasicExecutionNode):
         if self.blocked or self.end_reached:
             return
 
-        #print '[', self.id, ']', self.ip, self.state, ':', instr
-
-        # MOV
         self.blocked = True
+        self.state = NODE_STATE_WRITE
+        self.outbox[self.port].offer(self.values[self.ip])
 
-        value = self.values[self.ip]
-        dest = self.neighbors.keys()[0]
-
-        if dest in PORTS_LIST:
-            self.write(dest, value)
-            return
-        else:
-            raise Exception()
-        #     self.regs[dest] = value
-        #
-        # self.blocked = False
-        #
-        # self.fetch_next()
 
+class OutputNode(IONode):
+    __slots__ = ('len_objective', 'regs')
 
-class OutputNode(BasicExecutionNode):
     def __init__(self, _id=None):
-        super(OutputNode, self).__init__(_id)
-        self.regs = { REG_ACC: 0,
-                      REG_LEFT: None, REG_RIGHT: None, REG_UP: None, REG_DOWN: None }
-        self.values = []
+        # sits below the grid
+        super(OutputNode, self).__init__(_id, PORT_UP)
         self.len_objective = 0
+        self.inbox[PORT_UP] = Mailbox(None, self, PORT_DOWN)
+        # the mailbox delivers to regs[port], like the port registers of a code node
+        self.regs = [None] * REGISTERS_COUNT
 
     def __repr__(self):
-        return "OutputNode %i %s\n" % (self.id, self.instr)
+        return "OutputNode %i %s\n" % (self.id, self.values)
 
-    def fetch_next(self):
-        pass
+    def reset(self):
+        super(OutputNode, self).reset()
+        # in place, the generated grid holds on to this list
+        self.regs[self.port] = None
 
-    def before_cycle(self):
-        if self.deadlock and self.state == NODE_STATE_READ:
-            #print self.id, "deadlock", self.state
-            direction = self.neighbors.keys()[0]
-            neighbor = self.neighbors[direction]
-            value = neighbor.read_port(direction)
-            if value is not None:
-                #self.values.append(value)
-                self.regs[direction] = value
-                self.blocked = False
-                self.deadlock = False
-                self.state = NODE_STATE_IDLE
-            else:
-                return
+    def connect(self, other, direction, switchboard):
+        # only ever reads, it has no mailbox towards the neighbor
+        switchboard.connect(other, self, OPPOSITE_PORT[direction])
+
+    def state_key(self):
+        return (self.state, self.blocked, self.regs[self.port])
 
     def cycle(self):
         self.cycle_count += 1
@@ -364,23 +532,14 @@ class OutputNode(BasicExecutionNode):
         if self.blocked:
             return
 
-        #print '[', self.id, ']', self.ip, self.state, ':', instr
-
-        # MOV
-        self.blocked = True
-
-        # value = self.values[self.ip]
-        src = self.neighbors.keys()[0]
-
-        if src in PORT_REGISTERS:
-            value = self.read_from(src)
-            if value is None:
-                return
-            self.values.append(value)
-        else:
-            raise Exception()
-            #value = self.regs[dest] = self.regs[src]
-
-        self.blocked = False
-
-        # self.fetch_next()
\ No newline at end of file
+        port = self.port
+        value = self.regs[port]
+        if value is None:
+            self.blocked = True
+            self.state = NODE_STATE_READ
+            self.inbox[port].wait()
+            return
+        # accepted from the mailbox at the start of this cycle
+        self.regs[port] = None
+        self.values.append(value)
+        self.state = NODE_STATE_READ
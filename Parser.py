@@ -6,7 +6,7 @@ from SymbolTable import SymbolTable
 class ParserError(Exception):
     def __init__(self, token_type=TNONE, token_value=None, line_pos=-1):
         if token_value is not None:
-            error = "Expected %s '%s'" % (lang_tokens[token_type], token_value)
+            error = "Expected %s '%s'" % (token_type, token_value)
         else:
             error = "Expected %s" % token_type
         if line_pos >= 0:
@@ -15,46 +15,39 @@ class ParserError(Exception):
 
 class Parser(object):
 
-    def __init__(self, symbol_table, instr):
+    def __init__(self, symbol_table, instr, first_line=1):
         self.lexer = TISLexer()
         self.instr = instr
         self.symbol_table = symbol_table
-        self.unresolved_symbols = [] # (id, addr)
+        # file line of the first line of the block, the lexer counts from 1 in it
+        self.first_line = first_line
 
     def parse(self, _input):
         self.lexer.lex(_input)
         while self.lexer.has_more_tokens():
             self.compile_tokens()
-        self._resolve_symbols()
-        if len(self.instr) > 0:
-            print "parser instr :", self.instr
-
-    def _resolve_symbols(self):
-        for id, addr in self.unresolved_symbols:
-            jump_addr = self.symbol_table.get(id)
-            if jump_addr is None:
-                Exception("Unresolved identifier %s" % id)
-            else:
-                self.instr[addr] = jump_addr
 
     def _expect(self, token_type, token_value=None):
         self._advance()
         if self.lexer.current_token.type != token_type:
-            raise ParserError(token_type, token_value, self.lexer.line_pos)
+            raise ParserError(token_type, token_value, self._file_line(self.lexer.line_pos))
         if token_value is not None:
             if self.lexer.current_token.value != token_value:
-                raise ParserError(token_type, token_value, self.lexer.line_pos)
+                raise ParserError(token_type, token_value, self._file_line(self.lexer.line_pos))
         return self.lexer.current_token.value
 
     def _expect_any(self, token_type, token_values_list=None):
         self._advance()
         if self.lexer.current_token.type != token_type:
-            raise ParserError(token_type, token_values_list, self.lexer.line_pos)
+            raise ParserError(token_type, token_values_list, self._file_line(self.lexer.line_pos))
         if token_values_list is not None:
             if self.lexer.current_token.value not in token_values_list:
-                raise ParserError(token_type, token_values_list, self.lexer.line_pos)
+                raise ParserError(token_type, token_values_list, self._file_line(self.lexer.line_pos))
         return self.lexer.current_token.value
 
+    def _file_line(self, line):
+        return line + self.first_line - 1
+
     def _advance(self):
         if self.lexer.has_more_tokens():
             self.lexer.advance()
@@ -76,14 +69,15 @@ class Parser(object):
         return token.type == token_type and token.value in token_values_list
 
     def compile_tokens(self):
+        line_num = self.lexer.peek_next_token().line
         if self._is_token(TCOMMAND):
             self.compile_command()
         elif self._is_token(TIDENTIFIER):
             self._compile_label_addr()
         else:
-            print self.lexer.peek_next_token()
             # todo fix this ugly shitty broken design for the line number
-            raise ParserError(TCOMMAND, None, self.lexer.lines_number[self.lexer._index+1])
+            raise ParserError(TCOMMAND, None, self._file_line(line_num))
+        self.instr[-1].line_num = line_num
 
     def _compile_label_addr(self):
         label = self._expect(TIDENTIFIER)
@@ -120,13 +114,12 @@ class Parser(object):
         elif self._is_token(TCOMMAND, KW_HCF):
             self._compile_halt()
         else:
-            print self.lexer.peek_next_token()
             # todo fix this ugly shitty broken design for the line number
-            raise ParserError(TCOMMAND, None, self.lexer.lines_number[self.lexer._index+1])
+            raise ParserError(TCOMMAND, None, self._file_line(self.lexer.peek_next_token().line))
 
     def _compile_halt(self):
         self._expect(TCOMMAND, KW_HCF)
-        self.instr.append(Instruction(KW_HCF))
+        self.instr.append(Instruction(INSTR_HCF))
 
     def _compile_nop(self):
         self._expect(TCOMMAND, KW_NOP)
@@ -201,5 +194,9 @@ class Parser(object):
 
     def _compile_jro(self):
         self._expect(TCOMMAND, KW_JRO)
-        label = self._expect(TIDENTIFIER)
-        self.instr.append(Instruction(INSTR_JRO, label))
+        src = None
+        if self._is_token(TINTEGER):
+            src = int(self._expect(TINTEGER))
+        else:
+            src = self._expect(TREGISTER)
+        self.instr.append(Instruction(INSTR_JRO, src))
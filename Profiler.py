@@ -0,0 +1,72 @@
+from Enums import *
+
+class Profile(object):
+    '''Cycles of a counted run by line of the source file.
+
+    Built from the counters a run with counters=True leaves on the VM.
+    Every instruction maps to its file line through its node, so the
+    listing and the collapsed stacks point at the lines of the .tis file.
+    Without the source text, for a program loaded from an image, the
+    instructions stand in for their lines.
+    '''
+
+    def __init__(self, vm):
+        if vm.counters is None:
+            raise ValueError("Profiling needs a run with counters")
+        self.counters = vm.counters
+        self.source = None
+        if vm.source_file is not None:
+            f = open(vm.source_file, 'r')
+            self.source = f.read().splitlines()
+            f.close()
+
+    def lines(self):
+        '''Yields (node, file line, instruction, executed, read stalls, write stalls)'''
+        for counters in self.counters.nodes:
+            node = counters.node
+            for ip, instr in enumerate(node.instr):
+                yield (node, node.file_line(instr), instr, counters.executed[ip],
+                       counters.read_stalls[ip], counters.write_stalls[ip])
+
+    def by_line(self):
+        '''Executed, read and write stall cycles of every file line'''
+        totals = {}
+        for node, line, instr, executed, read, write in self.lines():
+            total = totals.setdefault(line, [0, 0, 0])
+            total[0] += executed
+            total[1] += read
+            total[2] += write
+        return totals
+
+    def line_text(self, line, instr):
+        if self.source is not None and 0 < line <= len(self.source):
+            return self.source[line - 1].strip()
+        return repr(instr)
+
+    def write_listing(self, f):
+        '''Writes the source with the cycles, runs and stalls of every line'''
+        f.write('%8s %8s %8s %8s | %5s\n' % ('cycles', 'run', 'read', 'write', 'line'))
+        totals = self.by_line()
+        if self.source is None:
+            for node, line, instr, executed, read, write in self.lines():
+                f.write('%8d %8d %8d %8d | %5d  @%d %r\n' % (executed + read + write, executed,
+                                                         read, write, line, node.id, instr))
+            return
+        for line, text in enumerate(self.source, 1):
+            total = totals.get(line)
+            if total is None:
+                f.write('%35s | %5d  %s\n' % ('', line, text))
+            else:
+                f.write('%8d %8d %8d %8d | %5d  %s\n' % (sum(total), total[0], total[1], total[2],
+                                                       line, text))
+
+    def write_collapsed(self, f):
+        '''Writes node;line;kind stacks with their cycles, one per line, for flame graphs'''
+        for node, line, instr, executed, read, write in self.lines():
+            frame = '@%d;%d %s' % (node.id, line, self.line_text(line, instr).replace(';', ','))
+            if executed > 0:
+                f.write('%s;run %d\n' % (frame, executed))
+            if read > 0:
+                f.write('%s;read %s %d\n' % (frame, instr.src_name(), read))
+            if write > 0:
+                f.write('%s;write %s %d\n' % (frame, instr.dest_name(), write))
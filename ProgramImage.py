@@ -0,0 +1,128 @@
+import struct
+from Enums import *
+
+IMAGE_EXTENSION = '.tisc'
+IMAGE_MAGIC = 'TISC'
+IMAGE_VERSION = 1
+
+# magic, version, nodes, instructions, symbols, strings
+HEADER = struct.Struct('<4sHHHHH')
+# node id, source line, first instruction, instructions, first symbol, symbols
+NODE = struct.Struct('<HHHHHH')
+# type, src type, dest, src, target, line in the node block
+INSTR = struct.Struct('<BBBxhhH')
+# string index of the label, address
+SYMBOL = struct.Struct('<HH')
+
+NO_DEST = 0xff
+NO_TARGET = -1
+
+class ImageError(Exception):
+    pass
+
+
+def write_image(nodes, filename):
+    '''Writes the linked programs of the nodes as a .tisc image.
+
+    The image is a header, a node table, fixed-width instruction and
+    symbol records, and a string table holding the label names. A jump
+    keeps its label as a string index next to its resolved target.
+    '''
+    strings = []
+    string_index = {}
+    def intern(string):
+        if string not in string_index:
+            if len(string) > 0xff:
+                raise ImageError("Label too long: %s" % string)
+            string_index[string] = len(strings)
+            strings.append(string)
+        return string_index[string]
+
+    node_records = []
+    instr_records = []
+    symbol_records = []
+    for node in nodes:
+        if len(node.instr) < 1 and len(node.symtable.table) < 1:
+            continue
+        node_records.append(NODE.pack(node.id, node.source_line, len(instr_records), len(node.instr),
+                                      len(symbol_records), len(node.symtable.table)))
+        for instr in node.instr:
+            src = instr.src
+            if instr.src_type == SRC_TYPE_LABEL:
+                src = intern(src)
+            elif src is None:
+                src = 0
+            dest = NO_DEST if instr.dest is None else instr.dest
+            target = NO_TARGET if instr.target is None else instr.target
+            instr_records.append(INSTR.pack(instr.type, instr.src_type, dest, src, target, instr.line_num))
+        for label, addr in sorted(node.symtable.table.iteritems()):
+            symbol_records.append(SYMBOL.pack(intern(label), addr))
+
+    f = open(filename, 'wb')
+    f.write(HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, len(node_records), len(instr_records),
+                        len(symbol_records), len(strings)))
+    f.write(''.join(node_records))
+    f.write(''.join(instr_records))
+    f.write(''.join(symbol_records))
+    for string in strings:
+        f.write(chr(len(string)))
+        f.write(string)
+    f.close()
+
+
+def read_image(filename):
+    '''Returns (node id, source line, node image) for every node of a .tisc file.
+
+    Every node is built right after loading, so the whole image is read
+    and decoded at once.
+    '''
+    f = open(filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if len(data) < 1:
+        raise ImageError("Empty image: %s" % filename)
+    try:
+        return _decode(data)
+    except (struct.error, IndexError):
+        raise ImageError("Truncated image: %s" % filename)
+
+
+def _decode(data):
+    magic, version, node_count, instr_count, symbol_count, string_count = HEADER.unpack_from(data, 0)
+    if magic != IMAGE_MAGIC:
+        raise ImageError("Not a .tisc image")
+    if version != IMAGE_VERSION:
+        raise ImageError("Unsupported .tisc version %d" % version)
+
+    nodes_offset = HEADER.size
+    instr_offset = nodes_offset + node_count * NODE.size
+    symbol_offset = instr_offset + instr_count * INSTR.size
+    offset = symbol_offset + symbol_count * SYMBOL.size
+    strings = []
+    for i in range(string_count):
+        length = ord(data[offset])
+        strings.append(data[offset + 1:offset + 1 + length])
+        offset += 1 + length
+
+    nodes = []
+    for i in range(node_count):
+        node_id, source_line, first_instr, count, first_symbol, symbols = \
+            NODE.unpack_from(data, nodes_offset + i * NODE.size)
+        instructions = []
+        for index in range(first_instr, first_instr + count):
+            _type, src_type, dest, src, target, line_num = \
+                INSTR.unpack_from(data, instr_offset + index * INSTR.size)
+            if src_type == SRC_TYPE_LABEL:
+                src = strings[src]
+            elif src_type == SRC_TYPE_NONE:
+                src = None
+            instructions.append((_type, None, src, None if dest == NO_DEST else dest, src_type,
+                                 None if target == NO_TARGET else target, line_num))
+        table = {}
+        for index in range(first_symbol, first_symbol + symbols):
+            string, addr = SYMBOL.unpack_from(data, symbol_offset + index * SYMBOL.size)
+            table[strings[string]] = addr
+        nodes.append((node_id, source_line, (instructions, table)))
+    return nodes
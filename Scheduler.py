@@ -0,0 +1,502 @@
+import time
+from Node import InputNode, OutputNode
+from Trace import TRACE_CYCLE, TRACE_INSTR
+from Codegen import generate_grid
+from Streams import InputStream, OutputStream
+from Validation import CheckedValues
+from Enums import *
+
+# how many cycles run between two checks of the wall-clock budget
+CLOCK_CHECK_INTERVAL = 256
+# how many cycles run between two machine states kept by the loop detector
+CHECKPOINT_INTERVAL = 64
+MAX_CHECKPOINTS = 4096
+# most instructions a node runs in one macro step
+MAX_BLOCK = 1024
+
+class Scheduler(object):
+    def __init__(self, vm):
+        self.vm = vm
+        self.cycle = 0
+        self.max_cycles = None
+        self.trace = vm.trace
+        # checked once per cycle so a run without tracing stays cheap
+        self.tracing = vm.trace.enabled(TRACE_CYCLE)
+        # counted instructions must run one cycle at a time
+        self.counting = vm.counters is not None
+        # the outputs that must all reach their objective to complete the run
+        self.objectives = [node for node in vm.output_nodes if node.len_objective is not None]
+
+    def start(self):
+        pass
+
+    def step(self):
+        '''Runs one cycle, returns the run status once the VM stops'''
+        raise NotImplementedError
+
+    def sync(self):
+        pass
+
+    def run(self, max_cycles=None, time_budget=None, fast_forward=False):
+        self.max_cycles = max_cycles
+        self.start()
+        deadline = None
+        if time_budget is not None:
+            deadline = time.time() + time_budget
+        detector = None
+        if fast_forward:
+            detector = LoopDetector(self)
+        validation = self.vm.validation
+        stuck = []
+        while True:
+            status = self.step()
+            if status is None:
+                stuck = self.stalled()
+                if stuck is not None:
+                    status = RUN_DEADLOCK
+                    if self.drained():
+                        status = RUN_COMPLETED
+                        stuck = []
+                elif detector is not None and self.cycle % CHECKPOINT_INTERVAL == 0:
+                    self.sync()
+                    status = detector.checkpoint(max_cycles)
+            if status is None:
+                if max_cycles is not None and self.cycle >= max_cycles:
+                    status = RUN_CYCLE_LIMIT
+                elif deadline is not None and self.cycle % CLOCK_CHECK_INTERVAL == 0 \
+                        and time.time() > deadline:
+                    status = RUN_TIMEOUT
+            if validation is not None and validation.failed:
+                # a wrong value ends the run whatever else happened this cycle
+                status = RUN_MISMATCH
+            if status is not None:
+                self.sync()
+                return self.vm.result(status, stuck or [])
+
+    def next_cycle(self):
+        self.cycle += 1
+        self.vm.cycle = self.cycle
+
+    def trace_cycle(self):
+        trace = self.trace
+        trace.emit(TRACE_CYCLE, 'cycle', cycle=self.cycle)
+        if trace.enabled(TRACE_INSTR):
+            for node in self.vm.nodes:
+                if len(node.instr) > 0:
+                    trace.emit(TRACE_INSTR, 'node', cycle=self.cycle, node=node.id, ip=node.ip,
+                               state=node.state_name(), instr=repr(node.fetch()), regs=node.regs_view())
+
+    def skip(self, cycles):
+        self.cycle += cycles
+        self.vm.cycle = self.cycle
+        for node in self.vm.input_nodes + self.vm.nodes + self.vm.output_nodes:
+            node.cycle_count += cycles
+
+    @staticmethod
+    def read_direction(node):
+        if isinstance(node, OutputNode):
+            return node.port
+        return node.fetch().src
+
+    @staticmethod
+    def write_direction(node):
+        if isinstance(node, InputNode):
+            return node.port
+        return node.fetch().dest
+
+    def stalled(self):
+        '''Returns the stuck nodes when no node can make progress anymore'''
+        vm = self.vm
+        for node in vm.nodes:
+            if len(node.instr) > 0 and not node.blocked:
+                return None
+        for node in vm.input_nodes:
+            if not node.blocked and not node.end_reached and len(node.values) > 0:
+                return None
+        for node in vm.output_nodes:
+            if not node.blocked:
+                return None
+        if len(vm.switchboard.ready) > 0:
+            return None
+        return self.stuck_nodes()
+
+    def drained(self):
+        '''True when a run without a known objective sent every input value.
+
+        A streamed input does not tell its length up front, so once all of
+        it went through and the grid stalled the run is complete.
+        '''
+        vm = self.vm
+        outputs = vm.output_nodes
+        if len(outputs) < 1 or len(self.objectives) == len(outputs):
+            return False
+        for node in self.objectives:
+            if len(node.values) < node.len_objective:
+                return False
+        for node in vm.input_nodes:
+            if not node.end_reached and len(node.values) > 0:
+                return False
+        return True
+
+    def stuck_nodes(self):
+        stuck = []
+        for kind, nodes in (('input', self.vm.input_nodes), ('node', self.vm.nodes),
+                            ('output', self.vm.output_nodes)):
+            for node in nodes:
+                if not node.blocked:
+                    continue
+                if node.state == NODE_STATE_READ:
+                    direction = self.read_direction(node)
+                else:
+                    direction = self.write_direction(node)
+                stuck.append({'node': node.id, 'kind': kind, 'state': node.state_name(),
+                              'port': REGISTER_NAMES[direction]})
+        return stuck
+
+    def exit_status(self):
+        for node in self.vm.nodes:
+            if node.halted is True:
+                return RUN_HALTED
+        if self.completed():
+            return RUN_COMPLETED
+        return None
+
+    def completed(self):
+        '''True once every output with an objective got that many values'''
+        objectives = self.objectives
+        if len(objectives) < 1:
+            return False
+        for node in objectives:
+            if len(node.values) < node.len_objective:
+                return False
+        return True
+
+
+class LockstepScheduler(Scheduler):
+    '''Resolves the ready mailboxes, then steps every node, every cycle'''
+
+    def step(self):
+        self.next_cycle()
+        vm = self.vm
+        vm.switchboard.resolve()
+
+        for node in vm.input_nodes:
+            node.cycle()
+        for node in vm.nodes:
+            node.cycle()
+        for node in vm.output_nodes:
+            node.cycle()
+
+        if self.tracing:
+            self.trace_cycle()
+        return self.exit_status()
+
+
+class EventScheduler(Scheduler):
+    '''Only steps the nodes that can make progress.
+
+    Nodes without code are never scheduled. The nodes that can run are
+    kept in lockstep order and only listed again when one of them blocks
+    or a transfer wakes the nodes at both ends of a mailbox, so a cycle
+    costs one call per running node and nothing for the sleeping ones.
+    Every cycle_count is caught up on sync.
+    '''
+
+    def start(self):
+        vm = self.vm
+        self.code_nodes = [node for node in vm.nodes if len(node.instr) > 0]
+        # only these can end the run by halting
+        self.halting = [node for node in self.code_nodes
+                        if any(instr.type == INSTR_HCF for instr in node.instr)]
+        self.wake()
+
+    def wake(self):
+        '''Lists the nodes that can run, in lockstep order'''
+        vm = self.vm
+        self.inputs = [node for node in vm.input_nodes
+                       if not node.blocked and not node.end_reached and len(node.values) > 0]
+        self.running = [node for node in self.code_nodes if not node.blocked]
+        self.outputs = [node for node in vm.output_nodes if not node.blocked]
+        self.changed = False
+
+    def step(self):
+        self.next_cycle()
+        if len(self.vm.switchboard.resolve()) > 0 or self.changed:
+            self.wake()
+
+        # an input either blocks on its write or has nothing left to send
+        changed = len(self.inputs) > 0
+        for node in self.inputs:
+            node.cycle()
+        if self.run_nodes():
+            changed = True
+        for node in self.outputs:
+            node.cycle()
+            if node.blocked:
+                changed = True
+        self.changed = changed
+
+        if self.tracing:
+            self.trace_cycle()
+        for node in self.halting:
+            if node.halted:
+                return RUN_HALTED
+        if self.completed():
+            return RUN_COMPLETED
+        return None
+
+    def run_nodes(self):
+        '''Steps the running nodes with code, returns whether one of them blocked'''
+        changed = False
+        for node in self.running:
+            node.program[node.ip]()
+            if node.blocked:
+                changed = True
+        return changed
+
+    def stalled(self):
+        if self.changed:
+            self.wake()
+        if len(self.inputs) > 0 or len(self.running) > 0 or len(self.outputs) > 0 \
+                or len(self.vm.switchboard.ready) > 0:
+            return None
+        return self.stuck_nodes()
+
+    def sync(self):
+        for node in self.vm.input_nodes + self.vm.nodes + self.vm.output_nodes:
+            node.cycle_count = self.cycle
+
+
+class MacroScheduler(EventScheduler):
+    '''Runs whole blocks of local instructions in one step.
+
+    Local instructions only change their own node, so once a node reaches
+    one it runs on until its next port instruction or HCF, at most
+    MAX_BLOCK instructions, and sits out the cycles those took. When every
+    running node is inside a block the clock jumps to the end of the
+    first one, stopping on every checkpoint and at max_cycles. A node still
+    inside its block when the run stops or syncs is restored and replays
+    exactly the cycles that went by.
+    '''
+
+    def start(self):
+        super(MacroScheduler, self).start()
+        # a block needs two local instructions in a row
+        self.blocking = set(node for node in self.code_nodes if sum(node.local) > 1)
+        # last cycle taken by the current block of a node
+        self.busy = {}
+        # cycle, registers, ip and state of a node before its block
+        self.saved = {}
+
+    def run_nodes(self):
+        if self.tracing or self.counting or len(self.blocking) < 1:
+            return super(MacroScheduler, self).run_nodes()
+        cycle = self.cycle
+        busy = self.busy
+        blocking = self.blocking
+        changed = False
+        for node in self.running:
+            if node not in blocking:
+                node.program[node.ip]()
+                if node.blocked:
+                    changed = True
+                continue
+            if node in busy:
+                if busy[node] >= cycle:
+                    continue
+                del busy[node]
+                del self.saved[node]
+            local = node.local
+            program = node.program
+            ip = node.ip
+            if not local[ip]:
+                program[ip]()
+                if node.blocked:
+                    changed = True
+                continue
+            regs = node.regs[:]
+            state = node.state
+            program[ip]()
+            # the cycles past max_cycles would only be rolled back
+            limit = MAX_BLOCK
+            if self.max_cycles is not None:
+                limit = max(min(limit, self.max_cycles - cycle + 1), 1)
+            if limit < 2 or not local[node.ip]:
+                # a block of one cycle is a plain step
+                continue
+            self.saved[node] = (cycle, regs, ip, state)
+            count = 1
+            while count < limit and local[node.ip]:
+                program[node.ip]()
+                count += 1
+            busy[node] = cycle - 1 + count
+        return changed
+
+    def step(self):
+        status = super(MacroScheduler, self).step()
+        busy = self.busy
+        if status is None and len(busy) > 0 and len(self.vm.switchboard.ready) < 1:
+            if self.changed:
+                self.wake()
+            if len(self.inputs) > 0 or len(self.outputs) > 0 or len(busy) < len(self.running):
+                return status
+            # every running node is inside a block, nothing happens before the first one ends
+            ahead = min(busy.itervalues())
+            if ahead > self.cycle:
+                ahead = min(ahead, (self.cycle // CHECKPOINT_INTERVAL + 1) * CHECKPOINT_INTERVAL)
+                if self.max_cycles is not None:
+                    ahead = min(ahead, self.max_cycles)
+                self.cycle = self.vm.cycle = ahead
+        return status
+
+    def sync(self):
+        for node, (start, regs, ip, state) in self.saved.iteritems():
+            if self.busy[node] > self.cycle:
+                node.regs[:] = regs
+                node.ip = ip
+                node.state = state
+                for i in range(self.cycle - start + 1):
+                    node.program[node.ip]()
+        self.saved.clear()
+        self.busy.clear()
+        super(MacroScheduler, self).sync()
+
+
+def bound(value, limit):
+    if value is None:
+        return limit
+    return min(value, limit)
+
+
+class LoopDetector(object):
+    '''Fast-forwards a run through the periods of a steady state.
+
+    The state of every node is kept every CHECKPOINT_INTERVAL cycles, apart
+    from the input positions and the output values. When a state comes back
+    the machine replays the same period for as long as the inputs it reads
+    repeat, so the periods are skipped in one go up to the end of the
+    repeating inputs, the output objectives or the cycle limit. A period
+    without I/O and without any such bound never ends and is reported as
+    livelock. A checked output also stops the skip before the first value
+    that would not match, so the run gets to it one cycle at a time.
+    Streamed I/O keeps no history to replay, a run with any stream, or
+    expected values that can only be read in order, is never
+    fast-forwarded.
+    '''
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.vm = scheduler.vm
+        self.seen = {}
+        self.streaming = any(isinstance(node.values, (InputStream, OutputStream))
+                             for node in self.vm.input_nodes + self.vm.output_nodes) or \
+            any(isinstance(node.values, CheckedValues) and node.values.comparator.sequence is None
+                for node in self.vm.output_nodes)
+
+    def state_key(self):
+        vm = self.vm
+        return tuple(node.state_key() for node in vm.input_nodes + vm.nodes + vm.output_nodes)
+
+    def positions(self):
+        return ([node.ip for node in self.vm.input_nodes],
+                [len(node.values) for node in self.vm.output_nodes])
+
+    def checkpoint(self, max_cycles=None):
+        if self.streaming:
+            return None
+        cycle = self.scheduler.cycle
+        key = self.state_key()
+        seen = self.seen.get(key)
+        if seen is None:
+            if len(self.seen) >= MAX_CHECKPOINTS:
+                self.seen.clear()
+            self.seen[key] = (cycle,) + self.positions()
+            return None
+
+        start, input_ips, output_lens = seen
+        period = cycle - start
+        periods = self.periods(input_ips, output_lens)
+        if max_cycles is not None:
+            periods = bound(periods, (max_cycles - cycle) // period)
+        if periods is None:
+            return RUN_LIVELOCK
+        if periods > 0:
+            self.forward(periods, period, input_ips, output_lens)
+        self.seen.clear()
+        self.seen[self.state_key()] = (self.scheduler.cycle,) + self.positions()
+        return None
+
+    def periods(self, input_ips, output_lens):
+        '''Number of periods that replay exactly, None when unbounded'''
+        periods = None
+        for node, ip in zip(self.vm.input_nodes, input_ips):
+            step = node.ip - ip
+            if step == 0:
+                continue
+            # every value read from now on must match the one read a period before
+            x = node.ip
+            while x < len(node.values) and node.values[x] == node.values[x - step]:
+                x += 1
+            periods = bound(periods, max(x - 1 - node.ip, 0) // step)
+        for node, length in zip(self.vm.output_nodes, output_lens):
+            step = len(node.values) - length
+            if step == 0:
+                continue
+            if node.len_objective is not None:
+                # stop a period short of the objective and let the run complete it,
+                # an output already past it only writes more one cycle at a time
+                periods = bound(periods, max(node.len_objective - len(node.values) - 1, 0) // step)
+            if isinstance(node.values, CheckedValues):
+                periods = bound(periods, self.matching(node.values, step) // step)
+        return periods
+
+    def matching(self, values, step):
+        '''How many values a checked output gets right when it repeats its last step ones'''
+        comparator = values.comparator
+        # the values the output started with are not checked
+        offset = len(values) - comparator.index
+        end = len(values)
+        x = end
+        while True:
+            expected = comparator.expected_at(x - offset)
+            if x - step < end:
+                previous = values[x - step]
+            else:
+                # the values up to here match, the repeated one is the expected one
+                previous = comparator.expected_at(x - step - offset)
+            if expected is None or expected != previous:
+                return x - end
+            x += 1
+
+    def forward(self, periods, period, input_ips, output_lens):
+        for node, ip in zip(self.vm.input_nodes, input_ips):
+            node.ip += periods * (node.ip - ip)
+        for node, length in zip(self.vm.output_nodes, output_lens):
+            node.values.extend(node.values[length:] * periods)
+        self.scheduler.skip(periods * period)
+
+
+class FusedScheduler(Scheduler):
+    '''Lockstep cycles through one generated function for the whole grid'''
+
+    def start(self):
+        self.fused_cycle = generate_grid(self.vm)
+
+    def step(self):
+        self.next_cycle()
+        status = self.fused_cycle()
+        if self.tracing:
+            self.trace_cycle()
+        return status
+
+    def sync(self):
+        for node in self.vm.input_nodes + self.vm.nodes + self.vm.output_nodes:
+            node.cycle_count = self.cycle
+
+
+SCHEDULERS = {
+    'lockstep': LockstepScheduler,
+    'event': EventScheduler,
+    'fused': FusedScheduler,
+    'macro': MacroScheduler,
+}
@@ -0,0 +1,195 @@
+import struct, collections
+
+# one value of a binary stream, TIS values always fit
+VALUE = struct.Struct('<h')
+# values an input stream keeps before the one it sends next
+INPUT_WINDOW = 1024
+# values an output stream holds before passing them to its sink
+OUTPUT_BUFFER = 4096
+
+class StreamError(Exception):
+    pass
+
+
+def read_values(f, binary=False, chunk_size=4096):
+    '''Yields the values of a file or pipe.
+
+    A text stream holds integers separated by whitespace, a binary stream
+    little-endian 16-bit integers.
+    '''
+    if not binary:
+        for line in f:
+            for word in line.split():
+                yield int(word)
+        return
+    rest = ''
+    while True:
+        data = f.read(chunk_size * VALUE.size)
+        if not data:
+            break
+        data = rest + data
+        count = len(data) // VALUE.size
+        rest = data[count * VALUE.size:]
+        for value in struct.unpack('<%dh' % count, data[:count * VALUE.size]):
+            yield value
+    if rest:
+        raise StreamError("Binary stream ends in the middle of a value")
+
+
+def is_binary(f):
+    return 'b' in getattr(f, 'mode', '')
+
+
+class InputStream(object):
+    '''Values of an input node, pulled from an iterable as the node needs them.
+
+    Looks like the list of an input node to the engines: the stream reads
+    one value past the last one asked for, so len() tells whether the next
+    one exists, and only keeps INPUT_WINDOW values before that. Files and
+    pipes are read with read_values.
+    '''
+
+    def __init__(self, source, window=INPUT_WINDOW):
+        if hasattr(source, 'read'):
+            source = read_values(source, is_binary(source))
+        self.source = iter(source)
+        self.window = window
+        self.buffer = collections.deque()
+        # index of the first buffered value
+        self.start = 0
+        # one past the highest index asked for
+        self.wanted = 0
+        self.done = False
+
+    def __repr__(self):
+        return "InputStream %d-%d" % (self.start, self.start + len(self.buffer))
+
+    def _fill(self, index):
+        buffer = self.buffer
+        while not self.done and self.start + len(buffer) <= index:
+            try:
+                buffer.append(int(next(self.source)))
+            except StopIteration:
+                self.done = True
+
+    def __len__(self):
+        self._fill(self.wanted)
+        return self.start + len(self.buffer)
+
+    def __getitem__(self, index):
+        if index < self.start:
+            raise StreamError("Input value %d is no longer buffered" % index)
+        if index + 1 > self.wanted:
+            self.wanted = index + 1
+            buffer = self.buffer
+            while self.start < self.wanted - self.window:
+                buffer.popleft()
+                self.start += 1
+        self._fill(index + 1)
+        if index >= self.start + len(self.buffer):
+            raise IndexError(index)
+        return self.buffer[index - self.start]
+
+
+class PackedValues(object):
+    '''Values of an input node, read from a buffer of packed VALUEs.
+
+    The buffer is usually a memory-mapped packed fixture, the values are
+    only decoded when a node asks for them.
+    '''
+
+    __slots__ = ('data', 'offset', 'count')
+
+    def __init__(self, data, offset, count):
+        self.data = data
+        self.offset = offset
+        self.count = count
+
+    def __repr__(self):
+        return "PackedValues %d" % self.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError(index)
+        return VALUE.unpack_from(self.data, self.offset + index * VALUE.size)[0]
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield VALUE.unpack_from(self.data, self.offset + index * VALUE.size)[0]
+
+
+class OutputStream(object):
+    '''Values of an output node, passed on to a sink in bounded chunks.
+
+    The sink is a callable taking a list of values, or a file or socket
+    like object the values are written to, one per line or binary like
+    read_values reads them. Only the values not flushed yet are kept.
+    expected holds the values the output should get, compared as they
+    arrive by the comparator a validated run attaches.
+    length is the objective of the output when the inputs are streams
+    themselves and their length is not known up front.
+    '''
+
+    def __init__(self, sink=None, expected=None, length=None, buffer_size=OUTPUT_BUFFER, binary=None):
+        self.sink = sink
+        if binary is None:
+            binary = is_binary(sink)
+        self.binary = binary
+        self.length = length
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.count = 0
+        self.expected = expected
+        self.comparator = None
+
+    def __repr__(self):
+        return "OutputStream %d" % self.count
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        if self.comparator is not None:
+            self.comparator.check(value)
+        self.count += 1
+        self.buffer.append(value)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        values, self.buffer = self.buffer, []
+        if len(values) < 1 or self.sink is None:
+            return
+        sink = self.sink
+        if callable(sink):
+            sink(values)
+            return
+        if self.binary:
+            data = struct.pack('<%dh' % len(values), *values)
+        else:
+            data = ''.join('%d\n' % value for value in values)
+        if hasattr(sink, 'sendall'):
+            sink.sendall(data)
+        else:
+            sink.write(data)
+
+
+def input_values(source):
+    '''Values for an input node: a copy of a list, a stream for anything else'''
+    if isinstance(source, list):
+        return source[:]
+    if isinstance(source, (InputStream, PackedValues)):
+        return source
+    return InputStream(source)
+
+
+def output_values(values):
+    '''Values for an output node: a copy of a list or the stream itself'''
+    if isinstance(values, OutputStream):
+        return values
+    return list(values)
@@ -16,7 +16,7 @@ class SymbolTable(object):
 
     def add(self, key, value):
         if self.has(key):
-            Exception("The identifier %s is already present in the symbol table" % key)
+            raise Exception("The identifier %s is already present in the symbol table" % key)
         self.table[key] = int(value)
 
     def has(self, key):
@@ -0,0 +1,87 @@
+import sys, json, collections
+
+# trace levels, each one includes the ones before it
+TRACE_OFF     = 0
+TRACE_SUMMARY = 1
+TRACE_CYCLE   = 2
+TRACE_INSTR   = 3
+TRACE_LEVELS = {'off': TRACE_OFF, 'summary': TRACE_SUMMARY, 'cycle': TRACE_CYCLE, 'instr': TRACE_INSTR}
+
+
+class RingBufferSink(object):
+    '''Keeps the last events in memory'''
+
+    def __init__(self, size=10000):
+        self.events = collections.deque(maxlen=size)
+
+    def emit(self, event):
+        self.events.append(event)
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink(object):
+    '''Writes one JSON object per event'''
+
+    def __init__(self, output):
+        self.own_file = isinstance(output, basestring)
+        self.file = open(output, 'w') if self.own_file else output
+
+    def emit(self, event):
+        self.file.write(json.dumps(event, default=repr))
+        self.file.write('\n')
+
+    def close(self):
+        if self.own_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+class StdoutSink(object):
+    def __init__(self, output=None):
+        self.file = output or sys.stdout
+
+    def emit(self, event):
+        fields = ' '.join("%s=%s" % (key, event[key]) for key in sorted(event) if key != 'event')
+        self.file.write("%s %s\n" % (event['event'], fields))
+
+    def close(self):
+        self.file.flush()
+
+
+class Tracer(object):
+    '''Sends the events up to a level to every sink.
+
+    Callers check the level before building an event, so a tracer left
+    off only costs that comparison.
+    '''
+
+    def __init__(self, level=TRACE_OFF, sinks=None):
+        self.level = level
+        self.sinks = sinks if sinks is not None else []
+
+    def enabled(self, level):
+        return self.level >= level
+
+    def emit(self, level, event, **fields):
+        if self.level < level:
+            return
+        fields['event'] = event
+        for sink in self.sinks:
+            sink.emit(fields)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def make_tracer(level='off', filename=None):
+    if isinstance(level, basestring):
+        level = TRACE_LEVELS[level]
+    if level == TRACE_OFF:
+        return Tracer()
+    if filename is None:
+        return Tracer(level, [StdoutSink()])
+    return Tracer(level, [JsonLinesSink(filename)])
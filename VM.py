@@ -1,163 +1,350 @@
 import re
 from Node import BasicExecutionNode, InputNode, OutputNode
+from Scheduler import SCHEDULERS
+from Mailbox import Switchboard
+from Grid import Grid, GridError, NO_NEIGHBOR
+from Streams import InputStream, OutputStream, input_values, output_values
+from Validation import Validation, CheckedValues
+from Counters import Counters, score
+from Trace import *
+from ProgramImage import IMAGE_EXTENSION, read_image, write_image
+from Fixture import FixtureError, find_fixture, load_fixture
 from Enums import *
 
 class VM(object):
-    def __init__(self):
+    def __init__(self, trace=None, cache=None, codegen=False):
+        self.trace = trace if trace is not None else Tracer()
+        self.cache = cache
+        # generated Python functions instead of closures for the node programs
+        self.codegen = codegen
+        self.grid = None
+        # the nodes with code, in position order
         self.nodes = []
+        # node of every grid position, None where there is no code
+        self.node_at = []
         self.input_nodes = []
         self.output_nodes = []
         self.input_values = []
         self.output_values = []
+        # values every output should get, None where it is not checked
+        self.expected_values = []
+        # test sets of the loaded puzzle, None without a fixture
+        self.fixture = None
+        self.validation = None
+        self.counters = None
+        # .tis file the nodes were parsed from
+        self.source_file = None
+        self.switchboard = Switchboard()
+        self.cycle = 0
 
-    def create_nodes(self):
-        self.nodes = []
-        for i in range(12):
-            node = BasicExecutionNode(i)
-            self.nodes.append(node)
+    def add_node(self, node_id):
+        node = BasicExecutionNode(node_id)
+        self.nodes.append(node)
+        return node
+
+    def create_nodes(self, width=None, height=None):
+        '''Lays the loaded nodes out on the grid and connects them.
 
+        Without a size from the puzzle the grid is WIDTH wide and as tall as
+        the highest node needs, at least HEIGHT rows. Positions without code
+        get no node at all.
+        '''
+        if width is None:
+            width = WIDTH
+        if height is None:
+            height = max([HEIGHT] + [node.id // width + 1 for node in self.nodes])
+        self.grid = Grid(width, height)
+        self.node_at = [None] * self.grid.size
+        nodes = []
+        for node in sorted(self.nodes, key=lambda node: node.id):
+            if node.id >= self.grid.size:
+                raise GridError("Node @%d is outside the %r" % (node.id, self.grid))
+            if len(node.instr) > 0:
+                self.node_at[node.id] = node
+                nodes.append(node)
+        self.nodes = nodes
+
+        self.switchboard = Switchboard()
         self.connect_nodes()
         self.create_input_nodes()
         self.create_output_nodes()
 
     def create_input_nodes(self):
+        self.input_nodes = []
         for i, input_vals in enumerate(self.input_values):
             if input_vals is not None:
                 node = InputNode(i)
-                node.values = input_vals[:]
-                node.connect(self.nodes[i], PORT_DOWN)
+                node.values = input_values(input_vals)
+                self.connect_io(node, self.node_at[i])
                 self.input_nodes.append(node)
 
     def create_output_nodes(self):
+        self.output_nodes = []
         for i, output_vals in enumerate(self.output_values):
             if output_vals is not None:
                 node = OutputNode(i)
-                node.values = output_vals[:]
-                pos = WIDTH * (HEIGHT - 1) + i
-                node.connect(self.nodes[pos], PORT_UP)
-                node.len_objective = len(self.input_nodes[0].values)
+                node.values = output_values(output_vals)
+                self.connect_io(node, self.node_at[self.grid.bottom(i)])
                 self.output_nodes.append(node)
+        # an objective depends on whether any of the outputs is checked
+        for node in self.output_nodes:
+            node.len_objective = self.objective(node)
+
+    def objective(self, node):
+        '''Number of values that completes an output, None when unknown.
+
+        A checked output needs as many values as it expects. Without any
+        checked output every output needs as many as the first input
+        sends, otherwise the unchecked ones are not waited for.
+        '''
+        if isinstance(node.values, OutputStream) and node.values.length is not None:
+            return node.values.length
+        expected = self.expected(node)
+        if expected is not None:
+            if not hasattr(expected, '__len__'):
+                # read in order, its length is only known at its end
+                return None
+            return len(node.values) + len(expected)
+        if any(self.expected(output) is not None for output in self.output_nodes):
+            return None
+        if len(self.input_nodes) < 1:
+            # nothing to count the values against, the run ends on a limit or a stall
+            return None
+        inputs = self.input_nodes[0].values
+        if isinstance(inputs, InputStream):
+            # a streamed run completes once its inputs went through and the grid stalls
+            return None
+        return len(inputs)
+
+    def connect_io(self, node, other):
+        # a port facing an empty position keeps mailboxes that never get ready
+        if other is not None:
+            node.connect(other, node.port, self.switchboard)
 
     def split_sourcecode(self, fn):
         f = open(fn, 'r')
         lines = f.read().splitlines()
         f.close()
-        print "split_sourcecode lines:", lines
+        self.split_lines(lines)
 
+    def split_lines(self, lines):
+        '''Gives every @N block of a program to its node'''
         i = 0
+        node = None
         node_id = -1
         defined_nodes_index = []
-        for line in lines:
+        nodes = {}
+        for line_index, line in enumerate(lines):
             word = re.match(r'@(\d+)', line)
             if word is not None:
                 defined_nodes_index.append(node_id)
                 node_id = int(word.group(1))
                 if node_id in defined_nodes_index:
                     raise Exception("Can't have the same node multiple times : @%i is already defined" % node_id)
+                node = nodes.get(node_id) or self.add_node(node_id)
+                nodes[node_id] = node
+                # file lines count from 1, the block starts after the @ line
+                node.source_line = line_index + 2
                 i = 0
-            elif i < 15 and len(self.nodes) > 0:
-                self.nodes[node_id].add_source_line(line)
-                #self.nodes[-1].parse(node_code_lines[:])
-            i += 1
-        print "split_sourcecode nodes:"
-        for node in self.nodes:
-            print node.id, node.source_code
-
-    def load(self, tis_filename):
-        import os, imp
-        if os.path.exists(tis_filename):
-            dir_name = os.path.dirname(tis_filename)
-            basename, extension = os.path.splitext(os.path.basename(tis_filename))
-            test_filename = dir_name + '/' + basename + '.py'
-            if os.path.exists(test_filename):
-                mod = imp.load_source(basename, test_filename)
-                self.add_input_list(mod, ['TIS_IN_0', 'TIS_IN_1', 'TIS_IN_2', 'TIS_IN_3'])
-                self.add_output_list(mod, ['TIS_OUT_0', 'TIS_OUT_1', 'TIS_OUT_2', 'TIS_OUT_3'])
-
-            self.create_nodes()
+            elif i < 15:
+                if node is None:
+                    # lines before any @ line go to the last node of the default grid
+                    node = self.add_node(WIDTH * HEIGHT - 1)
+                    nodes[node.id] = node
+                    node.source_line = line_index + 1
+                node.add_source_line(line)
+                # the @ line does not count against the lines of its block
+                i += 1
+        if self.trace.enabled(TRACE_INSTR):
+            for node in self.nodes:
+                self.trace.emit(TRACE_INSTR, 'source', node=node.id, lines=node.source_code)
+
+    def load(self, tis_filename, test_filename=None, test=0):
+        '''Loads a .tis source file or a .tisc image and a test set of its fixture.
+
+        Without a test_filename the fixture next to the program is used when
+        there is one, a named program or fixture must exist.
+        '''
+        import os
+        if not os.path.exists(tis_filename):
+            raise IOError("No such file: %s" % tis_filename)
+        extension = os.path.splitext(tis_filename)[1]
+        if test_filename is None:
+            test_filename = find_fixture(tis_filename)
+        elif not os.path.exists(test_filename):
+            raise FixtureError("No such fixture: %s" % test_filename)
+        width = height = None
+        if test_filename is not None:
+            self.fixture = load_fixture(test_filename)
+            width = self.fixture.width
+            height = self.fixture.height
+            self.use_test(self.fixture[test])
+
+        if extension == IMAGE_EXTENSION:
+            self.load_image(tis_filename)
+        else:
             self.split_sourcecode(tis_filename)
-            self.parse()
-
-    def add_input_list(self, mod, lst):
-        for i in lst:
-            if hasattr(mod, i):
-                self.input_values.append(getattr(mod, i))
-            else:
-                self.input_values.append(None)
-
-    def add_output_list(self, mod, lst):
-        for i in lst:
-            if hasattr(mod, i):
-                self.output_values.append(getattr(mod, i))
-            else:
-                self.output_values.append(None)
-
-    def parse(self):
-        '''Distributed parsing'''
-        for node in self.nodes:
-            node.parse()
+            self.source_file = tis_filename
+            self.build()
+        self.create_nodes(width, height)
+        self.trace.emit(TRACE_SUMMARY, 'load', file=tis_filename, fixture=test_filename,
+                        nodes=len([node for node in self.nodes if len(node.instr) > 0]))
 
-    def connect_nodes(self):
-        for row in range(HEIGHT):
-            for col in range(WIDTH):
-                node = self.nodes[WIDTH * row + col]
+    def use_test(self, test_set):
+        self.input_values = list(test_set.inputs)
+        self.output_values = list(test_set.outputs)
+        self.expected_values = list(test_set.expected)
 
-                if row > 0 and row < HEIGHT:
-                    other = self.nodes[WIDTH * (row - 1) + col]
-                    node.connect(other, PORT_UP)
+    def reset(self, test_set=None):
+        '''Rewinds the loaded program for another run, on test_set when given.
 
-                if col > 0 and col < WIDTH:
-                    other = self.nodes[WIDTH * row + (col - 1)]
-                    node.connect(other, PORT_LEFT)
+        The linked and compiled nodes and their links stay, only the
+        registers, ips, mailboxes and I/O positions go back to the start,
+        so running many test sets pays for loading once.
+        '''
+        if test_set is not None:
+            self.use_test(test_set)
+        self.cycle = 0
+        self.validation = None
+        self.counters = None
+        self.switchboard.ready = []
+        for node in self.nodes:
+            node.reset()
+        self.reset_io()
 
-        for row in range(HEIGHT):
-            for col in range(WIDTH):
-                node = self.nodes[WIDTH * row + col]
-                print node.id, node.neighbors
+    def reset_io(self):
+        '''Gives the I/O nodes their values again, new ones when the columns in use changed'''
+        inputs = [i for i, values in enumerate(self.input_values) if values is not None]
+        outputs = [i for i, values in enumerate(self.output_values) if values is not None]
+        if inputs != [node.id for node in self.input_nodes] or \
+                outputs != [node.id for node in self.output_nodes]:
+            self.create_input_nodes()
+            self.create_output_nodes()
+            return
+        for node in self.input_nodes:
+            node.reset()
+            node.values = input_values(self.input_values[node.id])
+        for node in self.output_nodes:
+            node.reset()
+            node.values = output_values(self.output_values[node.id])
+        for node in self.output_nodes:
+            node.len_objective = self.objective(node)
 
-    def run(self):
+    def build(self):
+        '''Parses, links and compiles every node, reusing cached images'''
         for node in self.nodes:
+            key = None
+            if self.cache is not None and len(node.source_code) > 0:
+                key = self.cache.key(node.source_code)
+                image = self.cache.get(key)
+                if image is not None:
+                    node.load_image(image)
+                    node.compile(self.codegen)
+                    continue
+            self.parse_node(node)
             node.first_pass()
+            node.link()
+            if key is not None:
+                self.cache.put(key, node.image())
+            node.compile(self.codegen)
 
-        # for i in range(20):
-        i = 1
-        while True:
-            for node in self.input_nodes:
-                node.before_cycle()
-            for node in self.nodes:
-                node.before_cycle()
-            for node in self.output_nodes:
-                node.before_cycle()
+    def load_image(self, filename):
+        for node_id, source_line, image in read_image(filename):
+            node = self.add_node(node_id)
+            node.source_line = source_line
+            node.load_image(image)
+            node.compile(self.codegen)
 
-            print "-- cycle", i
-            for node in self.input_nodes:
-                node.cycle()
-            for node in self.nodes:
-                node.cycle()
-            for node in self.output_nodes:
-                node.cycle()
+    def save_image(self, filename):
+        write_image(self.nodes, filename)
 
-            for node in self.input_nodes:
-                node.after_cycle()
-            for node in self.nodes:
-                node.after_cycle()
-                if len(node.instr) > 0:
-                    print '[', node.id, ']', node.ip, node.state, ':', node.fetch(), node.regs
-            for node in self.output_nodes:
-                node.after_cycle()
-
-            # exit
-            # for node in self.input_nodes:
-            #     if node.end_reached is True:
-            #         return
+    def parse_node(self, node):
+        node.parse()
+        if self.trace.enabled(TRACE_INSTR) and len(node.instr) > 0:
+            self.trace.emit(TRACE_INSTR, 'parse', node=node.id, tokens=node.parser.lexer._tokens,
+                            instr=node.instr)
+        # the tokens are not needed once the node has its instructions
+        node.parser = None
+
+    def connect_nodes(self):
+        grid = self.grid
+        for node in self.nodes:
+            for direction in (PORT_UP, PORT_LEFT):
+                index = grid.neighbor(node.id, direction)
+                if index != NO_NEIGHBOR and self.node_at[index] is not None:
+                    node.connect(self.node_at[index], direction, self.switchboard)
+
+        if self.trace.enabled(TRACE_INSTR):
             for node in self.nodes:
-                if node.halted is True:
-                    return
-            for node in self.output_nodes:
-                if len(node.values) == node.len_objective:
-                    return
-            #self.compare_io()
-            i += 1
+                self.trace.emit(TRACE_INSTR, 'neighbors', node=node.id,
+                                neighbors=dict((REGISTER_NAMES[box.direction], box.reader.id)
+                                               for box in node.outbox if box.reader is not None))
+
+    def make_scheduler(self, name='lockstep'):
+        return SCHEDULERS[name](self)
+
+    def run(self, scheduler='lockstep', max_cycles=None, time_budget=None, fast_forward=False,
+            stop_on_mismatch=True, counters=False):
+        '''Runs the loaded program and returns its status, score and report.
+
+        With counters on, the result also holds the performance counters
+        of every node. Counting needs every cycle to run, so it turns
+        fast-forwarding off.
+        '''
+        self.cycle = 0
+        self.validation = self.validate(stop_on_mismatch)
+        self.counters = Counters(self) if counters else None
+        if self.counters is not None:
+            fast_forward = False
+            self.counters.attach()
+        try:
+            result = self.make_scheduler(scheduler).run(max_cycles, time_budget, fast_forward)
+        finally:
+            if self.counters is not None:
+                self.counters.detach()
+        for node in self.output_nodes:
+            if isinstance(node.values, OutputStream):
+                node.values.flush()
+        mismatches = 0
+        if self.validation is not None:
+            if result['status'] == RUN_COMPLETED:
+                self.validation.finish()
+            result.update(self.validation.report())
+            mismatches = self.validation.count
+        result['passed'] = result['status'] == RUN_COMPLETED and mismatches == 0
+        if result['passed'] and self.validation is None:
+            # completed, but no output had expected values to check
+            result['passed'] = None
+        result['score'] = score(self)
+        if self.counters is not None:
+            result['counters'] = self.counters.report()
+        self.trace.emit(TRACE_SUMMARY, 'run', **result)
+        return result
+
+    def expected(self, node):
+        '''Values an output should get, None when it is not checked'''
+        if isinstance(node.values, OutputStream) and node.values.expected is not None:
+            return node.values.expected
+        if node.id < len(self.expected_values):
+            return self.expected_values[node.id]
+        return None
+
+    def validate(self, stop=True):
+        '''Checks the outputs with expected values as they get them, None without any'''
+        validation = Validation(stop)
+        for node in self.output_nodes:
+            expected = self.expected(node)
+            if isinstance(node.values, OutputStream):
+                if expected is not None:
+                    node.values.comparator = validation.comparator(node.id, expected)
+            elif expected is not None:
+                node.values = CheckedValues(node.values, validation.comparator(node.id, expected))
+        if len(validation.comparators) < 1:
+            return None
+        return validation
+
+    def result(self, status, stuck=None):
+        return {'status': status, 'cycles': self.cycle, 'stuck': stuck or []}
 
     def compare_io(self):
         for i, o in map(None, self.input_nodes, self.output_nodes):
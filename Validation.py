@@ -0,0 +1,98 @@
+from Streams import read_values, is_binary
+
+# mismatches kept in the report of a run, the others are only counted
+MAX_MISMATCHES = 100
+
+class Validation(object):
+    '''Expected outputs of a run and the mismatches found so far.
+
+    Every output with expected values gets a Comparator that checks each
+    value as the output node receives it. With stop set the first mismatch
+    marks the run failed and the scheduler stops it at the end of that
+    cycle, otherwise the run goes on and the report keeps the first limit
+    mismatches.
+    '''
+
+    def __init__(self, stop=True, limit=MAX_MISMATCHES):
+        self.stop = stop
+        self.limit = limit
+        self.failed = False
+        self.count = 0
+        self.mismatches = []
+        self.comparators = []
+
+    def comparator(self, output, expected):
+        comparator = Comparator(self, output, expected)
+        self.comparators.append(comparator)
+        return comparator
+
+    def mismatch(self, output, index, value, expected):
+        self.count += 1
+        if len(self.mismatches) < self.limit:
+            self.mismatches.append({'output': output, 'index': index, 'value': value,
+                                    'expected': expected})
+        if self.stop:
+            self.failed = True
+
+    def finish(self):
+        '''Reports the expected values a completed run never produced'''
+        for comparator in self.comparators:
+            comparator.finish()
+
+    def report(self):
+        return {'mismatches': self.mismatches, 'mismatch_count': self.count}
+
+
+class Comparator(object):
+    '''Checks the values of one output against its expected sequence'''
+
+    def __init__(self, validation, output, expected):
+        self.validation = validation
+        self.output = output
+        if hasattr(expected, 'read'):
+            expected = read_values(expected, is_binary(expected))
+        # a list can be looked ahead into, other iterables are only read in order
+        self.sequence = None
+        if hasattr(expected, '__getitem__') and hasattr(expected, '__len__'):
+            self.sequence = expected
+        self.expected = iter(expected)
+        self.index = 0
+
+    def expected_at(self, index):
+        '''Expected value at index of a sequence, None past its end'''
+        if index < len(self.sequence):
+            return self.sequence[index]
+        return None
+
+    def check(self, value):
+        expected = next(self.expected, None)
+        if value != expected:
+            self.validation.mismatch(self.output, self.index, value, expected)
+        self.index += 1
+
+    def finish(self):
+        expected = next(self.expected, None)
+        if expected is not None:
+            self.validation.mismatch(self.output, self.index, None, expected)
+
+
+class CheckedValues(list):
+    '''Values of an output node, checked as they are appended.
+
+    The values it starts with are not checked, so the prefix an output can
+    get from its fixture is left out of the comparison.
+    '''
+
+    __slots__ = ('comparator',)
+
+    def __init__(self, values, comparator):
+        super(CheckedValues, self).__init__(values)
+        self.comparator = comparator
+
+    def append(self, value):
+        list.append(self, value)
+        self.comparator.check(value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
@@ -1,9 +1,144 @@
+import sys, argparse
 from VM import VM
+from CompileCache import CompileCache
+from Trace import TRACE_LEVELS, make_tracer
+from Scheduler import SCHEDULERS
+from Profiler import Profile
+from Fixture import convert
+from Fuzzer import fuzz, describe, FUZZ_CYCLES
+from Benchmark import find_benchmarks, run_benchmarks, compare, read_baseline, write_baseline, \
+    format_record, BENCH_CYCLES
+from BatchRunner import find_jobs, run_jobs, write_report, summarize, format_stuck, \
+    format_mismatches
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='TIS-100 simulator')
+    parser.add_argument('program', nargs='?', default='scripts/test3.tis',
+                        help='.tis or .tisc file to run (default: %(default)s)')
+    parser.add_argument('--fixture', metavar='PATH',
+                        help='.tisf or .json fixture (default: the one next to the program)')
+    parser.add_argument('--test', type=int, default=0,
+                        help='test set of the fixture to run (default: %(default)s)')
+    parser.add_argument('--convert-fixture', nargs=2, metavar=('SRC', 'DEST'),
+                        help='convert a fixture, .py ones too, to a .json or packed .tisf one')
+    parser.add_argument('--compile', metavar='TISC',
+                        help='write the linked program to a .tisc image instead of running it')
+    parser.add_argument('--batch', metavar='PATH',
+                        help='directory of .tis files or manifest of (.tis, fixture) pairs')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes for --batch (default: cpu count)')
+    parser.add_argument('--chunksize', type=int, default=4,
+                        help='jobs sent to a worker at once (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds allowed per run, or per job with all its test sets in a batch, '
+                             '0 to disable (default: %(default)s)')
+    parser.add_argument('--unbatched', action='store_true',
+                        help='run the test sets of a --batch job one at a time instead of on a BatchVM')
+    parser.add_argument('--max-cycles', type=int, default=None,
+                        help='stop a run after this many cycles')
+    parser.add_argument('--fast-forward', action='store_true',
+                        help='skip the repeating periods of a steady state')
+    parser.add_argument('--trace', choices=sorted(TRACE_LEVELS), default='off',
+                        help='trace level of a single run (default: %(default)s)')
+    parser.add_argument('--trace-file', metavar='PATH',
+                        help='write the trace as JSON lines instead of text on stdout')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='reuse the parsed node programs stored in this directory')
+    parser.add_argument('--codegen', action='store_true',
+                        help='run node programs as generated Python functions')
+    parser.add_argument('--all-mismatches', action='store_true',
+                        help='run on after a wrong output value and report every mismatch')
+    parser.add_argument('--counters', action='store_true',
+                        help='count the cycles, stalls and instructions of every node')
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help='write the cycles of every source line to PREFIX.txt and '
+                             'flame graph stacks to PREFIX.folded')
+    parser.add_argument('--benchmark', metavar='JSON',
+                        help='time the sample and stress programs on every scheduler, '
+                             'or on the --batch ones, and write the results')
+    parser.add_argument('--baseline', metavar='JSON',
+                        help='flag the --benchmark numbers worse than this earlier result')
+    parser.add_argument('--bench-cycles', type=int, default=BENCH_CYCLES,
+                        help='cycles a benchmark runs at most (default: %(default)s)')
+    parser.add_argument('--fuzz', type=int, metavar='CASES',
+                        help='compare every engine cycle by cycle on random programs')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='first random seed of --fuzz (default: random)')
+    parser.add_argument('--fuzz-dir', default='fuzz',
+                        help='where --fuzz writes the shrunk failing cases (default: %(default)s)')
+    parser.add_argument('--scheduler', choices=sorted(SCHEDULERS), default='lockstep',
+                        help='cycle scheduler (default: %(default)s)')
+    parser.add_argument('--report', default='report.json',
+                        help='.json or .csv batch report (default: %(default)s)')
+    return parser.parse_args()
+
+def print_counters(counters):
+    print '%6s %8s %8s %8s %8s %6s  %s' % ('node', 'cycles', 'run', 'read', 'write', 'use', 'opcodes')
+    for row in counters['nodes'] + [dict(counters['total'], node='total')]:
+        opcodes = ' '.join('%s:%d' % item for item in sorted(row['opcodes'].iteritems()))
+        print '%6s %8d %8d %8d %8d %5.1f%%  %s' % (row['node'], row['cycles'], row['executed'],
+                                                  row['read_stalls'], row['write_stalls'],
+                                                  100 * row['utilization'], opcodes)
 
 if __name__ == '__main__':
-    vm = VM()
-    vm.load('scripts/test3.tis')
-    # vm.load('scripts/signal_edge_detector.tis')
-    # vm.load('scripts/mov_04.tis')
-    vm.run()
-    vm.compare_io()
\ No newline at end of file
+    args = parse_args()
+    if args.convert_fixture:
+        fixture = convert(*args.convert_fixture)
+        print '%d test sets written to %s' % (len(fixture), args.convert_fixture[1])
+    elif args.fuzz:
+        report = fuzz(args.fuzz, args.seed, args.workers, args.max_cycles or FUZZ_CYCLES, args.fuzz_dir)
+        for failure in report['failures']:
+            print 'seed %d: %s' % (failure['seed'], describe(failure['divergence']))
+        print '%d cases from seed %d, %d cycles in %gs, %d failures' % (
+            report['cases'], report['seed'], report['cycles'], report['seconds'], len(report['failures']))
+        if len(report['failures']) > 0:
+            print 'reproducers written to', args.fuzz_dir
+            sys.exit(1)
+    elif args.benchmark:
+        records = run_benchmarks(find_benchmarks([args.batch] if args.batch else None),
+                                 cycles=args.bench_cycles, codegen=args.codegen)
+        for record in records:
+            print format_record(record)
+        write_baseline(records, args.benchmark, args.bench_cycles)
+        if args.baseline:
+            regressions = compare(records, read_baseline(args.baseline))
+            for r in regressions:
+                print 'regression: %(tis)s %(scheduler)s %(field)s %(value)s, was %(baseline)s' % r
+            if len(regressions) > 0:
+                sys.exit(1)
+    elif args.batch:
+        records = run_jobs(find_jobs(args.batch), args.workers, args.chunksize, args.timeout,
+                           scheduler=args.scheduler, max_cycles=args.max_cycles,
+                           fast_forward=args.fast_forward, cache_dir=args.cache,
+                           codegen=args.codegen, stop_on_mismatch=not args.all_mismatches,
+                           batched=not args.unbatched)
+        write_report(records, args.report)
+        print summarize(records)
+    elif args.compile:
+        vm = VM()
+        vm.load(args.program)
+        vm.save_image(args.compile)
+    else:
+        trace = make_tracer(args.trace, args.trace_file)
+        vm = VM(trace, CompileCache(args.cache) if args.cache else None, args.codegen)
+        vm.load(args.program, args.fixture, args.test)
+        result = vm.run(args.scheduler, args.max_cycles, args.timeout or None, args.fast_forward,
+                        not args.all_mismatches, args.counters or args.profile is not None)
+        trace.close()
+        vm.compare_io()
+        print result['status'], 'after', result['cycles'], 'cycles'
+        print 'score: %(cycles)d cycles, %(nodes)d nodes, %(instructions)d instructions' % result['score']
+        if args.counters:
+            print_counters(result['counters'])
+        if args.profile:
+            profile = Profile(vm)
+            f = open(args.profile + '.txt', 'w')
+            profile.write_listing(f)
+            f.close()
+            f = open(args.profile + '.folded', 'w')
+            profile.write_collapsed(f)
+            f.close()
+        if len(result['stuck']) > 0:
+            print 'stuck:', format_stuck(result['stuck'])
+        if result.get('mismatch_count', 0) > 0:
+            print result['mismatch_count'], 'mismatches:', format_mismatches(result['mismatches'])
@@ -1,11 +0,0 @@
-
-TIS_IN_1 = [
-    0, 32, 30, 27, 24, 28, 37,
-    33, 24, 13, 9, 13, 9, 13,
-    12, 14, 23, 21, 23, 19, 9,
-    18, 8, -3, 6, 3, 14, 25,
-    15, 14, 3, 1, 2, -1, 1,
-    -10, -7, -7, -11
-]
-
-TIS_OUT_2 = []
\ No newline at end of file
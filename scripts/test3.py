@@ -1,22 +0,0 @@
-
-# INPUTS
-
-TIS_IN_0 = None
-TIS_IN_1 = [
-    66, 34, 88, 91, 53, 96, 96,
-    47, 68, 83, 59, 58, 56, 15,
-    81, 18, 95, 44, 72, 66, 14,
-    81, 43, 45, 23, 72, 33, 23,
-    29, 30, 58, 75, 44, 62, 38,
-    60, 82, 24, 52
-]
-TIS_IN_2 = None
-TIS_IN_3 = None
-
-
-# OUTPUTS
-
-TIS_OUT_0 = None
-TIS_OUT_1 = None
-TIS_OUT_2 = []
-TIS_OUT_3 = None